@@ -1,4 +1,5 @@
 save_dir                    = './logs'
+cache_dir                   = './cache'  # dataset indices, binary splits and episode manifests
 
 miniImageNet_path           	= './target_data/miniImagenet'
 miniImageNet_test_path          = './target_data/miniImagenet_test'
@@ -28,5 +28,59 @@ class ImageJitter(object):
         return out
 
 
+def _grayscale(x):
+    # ITU-R 601-2 luma, as PIL's convert('L')
+    r, g, b = x.unbind(dim=-3)
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(-3)
 
 
+def _smooth(x):
+    # PIL's ImageFilter.SMOOTH (as used by ImageEnhance.Sharpness); border pixels are left unchanged
+    kernel = torch.tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]], dtype=x.dtype, device=x.device) / 13
+    kernel = kernel.expand(x.shape[-3], 1, 3, 3)
+    out = x.clone()
+    out[..., 1:-1, 1:-1] = torch.nn.functional.conv2d(x, kernel, groups=x.shape[-3])
+    return out
+
+
+def _degenerate_brightness(x):
+    return torch.zeros_like(x)
+
+
+def _degenerate_contrast(x):
+    # Solid image of the (rounded) mean gray level
+    mean = _grayscale(x).mean(dim=(-3, -2, -1), keepdim=True)
+    return (torch.floor(mean * 255 + 0.5) / 255).expand_as(x)
+
+
+def _degenerate_color(x):
+    return _grayscale(x).expand_as(x)
+
+
+tensor_degeneratedict = dict(Brightness=_degenerate_brightness, Contrast=_degenerate_contrast,
+                             Sharpness=_smooth, Color=_degenerate_color)
+
+
+class TensorImageJitter(object):
+    """
+    Tensor implementation of `ImageJitter`, for float images in [0, 1] (i.e., after `ToTensor`) of shape [C, H, W] or
+    [B, C, H, W]. Each enhancement blends the image with the same degenerate image as `PIL.ImageEnhance`, with the
+    same random factors (drawn in the same order for a single image, and independently per image for a batch), but
+    without the intermediate rounding to 8 bits.
+    """
+    def __init__(self, transformdict):
+        self.transforms = [(tensor_degeneratedict[k], transformdict[k]) for k in transformdict]
+
+
+    def __call__(self, img):
+        batched = img.dim() == 4
+        out = img if batched else img.unsqueeze(0)
+        randtensor = torch.rand(out.shape[0], len(self.transforms)) if batched else torch.rand(1, len(self.transforms))
+
+        for i, (degenerate, alpha) in enumerate(self.transforms):
+            r = (alpha*(randtensor[:, i]*2.0 -1.0) + 1).to(out.device).view(-1, 1, 1, 1)
+            degenerated = degenerate(out)
+            out = (degenerated + r * (out - degenerated)).clamp_(0.0, 1.0)
+
+        return out if batched else out.squeeze(0)
+
@@ -11,15 +11,20 @@ from abc import abstractmethod
 class TransformLoader:
     def __init__(self, image_size, 
                  normalize_param    = dict(mean= [0.485, 0.456, 0.406] , std=[0.229, 0.224, 0.225]),
-                 jitter_param       = dict(Brightness=0.4, Contrast=0.4, Color=0.4)):
+                 jitter_param       = dict(Brightness=0.4, Contrast=0.4, Color=0.4),
+                 tensor_jitter      = False):
         self.image_size = image_size
         self.normalize_param = normalize_param
         self.jitter_param = jitter_param
+        self.tensor_jitter = tensor_jitter # jitter after ToTensor, without PIL round-trips (see TensorImageJitter)
     
     def parse_transform(self, transform_type):
         if transform_type=='ImageJitter':
             method = add_transforms.ImageJitter( self.jitter_param )
             return method
+        if transform_type=='TensorImageJitter':
+            method = add_transforms.TensorImageJitter( self.jitter_param )
+            return method
         method = getattr(transforms, transform_type)
         if transform_type=='RandomSizedCrop':
             return method(self.image_size) 
@@ -33,7 +38,10 @@ class TransformLoader:
             return method()
 
     def get_composed_transform(self, aug = False):
-        if aug:
+        if aug and self.tensor_jitter:
+            # Same order of random draws as below (RandomHorizontalFlip also works on tensors)
+            transform_list = ['RandomSizedCrop', 'ToTensor', 'TensorImageJitter', 'RandomHorizontalFlip', 'Normalize']
+        elif aug:
             transform_list = ['RandomSizedCrop', 'ImageJitter', 'RandomHorizontalFlip', 'ToTensor', 'Normalize']
         else:
             transform_list = ['Resize','CenterCrop', 'ToTensor', 'Normalize']
@@ -48,10 +56,10 @@ class DataManager(object):
         pass 
 
 class SimpleDataManager(DataManager):
-    def __init__(self, image_size, batch_size):        
+    def __init__(self, image_size, batch_size, tensor_jitter = False):        
         super(SimpleDataManager, self).__init__()
         self.batch_size = batch_size
-        self.trans_loader = TransformLoader(image_size)
+        self.trans_loader = TransformLoader(image_size, tensor_jitter = tensor_jitter)
 
     def get_data_loader(self, data_file, aug): #parameters that would change on train/val set
         transform = self.trans_loader.get_composed_transform(aug)
@@ -62,14 +70,14 @@ class SimpleDataManager(DataManager):
         return data_loader
 
 class SetDataManager(DataManager):
-    def __init__(self, image_size, n_way, n_support, n_query, n_eposide = 100):        
+    def __init__(self, image_size, n_way, n_support, n_query, n_eposide = 100, tensor_jitter = False):        
         super(SetDataManager, self).__init__()
         self.image_size = image_size
         self.n_way = n_way
         self.batch_size = n_support + n_query
         self.n_eposide = n_eposide
 
-        self.trans_loader = TransformLoader(image_size)
+        self.trans_loader = TransformLoader(image_size, tensor_jitter = tensor_jitter)
 
     def get_data_loader(self, data_file, aug): #parameters that would change on train/val set
         transform = self.trans_loader.get_composed_transform(aug)
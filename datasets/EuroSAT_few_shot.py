@@ -9,7 +9,7 @@ from PIL import ImageFile
 from torch.utils.data import Dataset
 from torchvision.datasets import ImageFolder
 
-from datasets.common import SubDataset, DataManager, TransformLoader, EpisodicBatchSampler
+from datasets.common import SubDataset, DataManager, TransformLoader, EpisodicBatchSampler, get_class_indices
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -55,48 +55,36 @@ class SimpleDataset:
         self.transform = transform
         self.target_transform = target_transform
 
-        self.meta = {}
-
-        self.meta['image_names'] = []
-        self.meta['image_labels'] = []
-
         self.d = ImageFolder(EuroSAT_path)
 
         if split:
             print("Using unlabeled split: ", split)
             self.d = construct_subset(self.d, labeled=False)
 
-        for i, (data, label) in enumerate(self.d):
-            self.meta['image_names'].append(data)
-            self.meta['image_labels'].append(label)
-
     def __getitem__(self, i):
-
-        img = self.transform(self.meta['image_names'][i])
-        target = self.target_transform(self.meta['image_labels'][i])
+        # Images are decoded on access, i.e., only paths and labels are kept in memory
+        data, label = self.d[i]
+        img = self.transform(data)
+        target = self.target_transform(label)
 
         return img, target
 
     def __len__(self):
-        return len(self.meta['image_names'])
+        return len(self.d)
 
 
 class SetDataset:
     def __init__(self, batch_size, transform, split):
-        self.sub_meta = {}
         self.cl_list = range(10)
 
-        for cl in self.cl_list:
-            self.sub_meta[cl] = []
-
         d = ImageFolder(EuroSAT_path)
 
         if split:
             print("Using labeled Split: ", split)
             d = construct_subset(d, labeled=True)
 
-        for i, (data, label) in enumerate(d):
-            self.sub_meta[label].append(data)
+        # Per-class sample indices into d; images are decoded on access by the sub datasets
+        self.sub_meta = get_class_indices(d, len(self.cl_list))
 
         for key, item in self.sub_meta.items():
             print(len(self.sub_meta[key]))
@@ -107,7 +95,7 @@ class SetDataset:
                                       num_workers=0,  # use main thread only or may receive multiple batches
                                       pin_memory=False)
         for cl in self.cl_list:
-            sub_dataset = SubDataset(self.sub_meta[cl], cl, transform=transform)
+            sub_dataset = SubDataset(self.sub_meta[cl], cl, transform=transform, dataset=d)
             self.sub_dataloader.append(torch.utils.data.DataLoader(sub_dataset, **sub_data_loader_params))
 
     def __getitem__(self, i):
@@ -0,0 +1,276 @@
+"""
+Batched, tensor-level equivalents of the augmentation recipes in `datasets.transforms`.
+
+The transforms operate on decoded but un-normalized images of shape [N, 3, H, W] with values in [0, 1] (see the `raw`
+recipe in `datasets.transforms.get_transform_list`) and draw random parameters independently for each sample. This is
+intended for the support set, which only needs to be decoded once per episode and can then be augmented every epoch
+with a handful of vectorized ops instead of N separate PIL pipelines.
+
+Implementation note: the outputs do not follow the same distribution as the PIL recipes. Images must share a size to
+be batched, so the `raw` recipe resizes them to a square of 1.15x the output size (`Resize_up`) before any
+augmentation, whereas PIL crops the original image. The area fraction of random crops is unaffected, but their
+aspect ratio is drawn relative to the squashed image, i.e., for non-square images, the range of crop shapes (in the
+original image) is shifted by the aspect ratio of the image. Crops of large images are also taken from fewer pixels.
+Recipes without crops are resized to the output size, as with PIL. In addition, crops and resizes use bilinear
+sampling (`F.grid_sample`, `F.interpolate`) rather than PIL resampling.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from datasets.transforms import get_transform_list, NORMALIZE_MEAN, NORMALIZE_STD
+
+
+def _uniform(n, low, high, device):
+    return torch.empty(n, device=device).uniform_(low, high)
+
+
+def _rgb_to_grayscale(x):
+    r, g, b = x.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def _blend(img1, img2, ratio):
+    return (ratio * img1 + (1.0 - ratio) * img2).clamp_(0.0, 1.0)
+
+
+def _crop_resize(x, top, left, height, width, size):
+    """
+    Crops box (top, left, height, width) from each image (per-sample float tensors of shape [N]) and resizes all crops
+    to (size, size) with a single `grid_sample` call.
+    """
+    n, c, h, w = x.shape
+    theta = torch.zeros(n, 2, 3, dtype=x.dtype, device=x.device)
+    theta[:, 0, 0] = width / w
+    theta[:, 0, 2] = (2 * left + width) / w - 1
+    theta[:, 1, 1] = height / h
+    theta[:, 1, 2] = (2 * top + height) / h - 1
+    grid = F.affine_grid(theta, [n, c, size, size], align_corners=False)
+    return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+class BatchCompose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+
+class BatchColorJitter:
+    """
+    Same parameters as `torchvision.transforms.ColorJitter` (without hue). Factors and the order in which brightness,
+    contrast and saturation are applied are drawn per sample.
+    """
+
+    def __init__(self, brightness, contrast, saturation):
+        self.ranges = [self._check_input(v) for v in [brightness, contrast, saturation]]
+        self.fns = [self._adjust_brightness, self._adjust_contrast, self._adjust_saturation]
+
+    @staticmethod
+    def _check_input(value):
+        if isinstance(value, (tuple, list)):
+            return float(value[0]), float(value[1])
+        return max(0.0, 1.0 - value), 1.0 + value
+
+    @staticmethod
+    def _adjust_brightness(img, factor):
+        return _blend(img, torch.zeros_like(img), factor)
+
+    @staticmethod
+    def _adjust_contrast(img, factor):
+        mean = _rgb_to_grayscale(img).mean(dim=(-3, -2, -1), keepdim=True)
+        return _blend(img, mean, factor)
+
+    @staticmethod
+    def _adjust_saturation(img, factor):
+        return _blend(img, _rgb_to_grayscale(img), factor)
+
+    def __call__(self, x):
+        n = x.shape[0]
+        factors = [_uniform(n, low, high, x.device).view(n, 1, 1, 1) for low, high in self.ranges]
+        order = torch.rand(n, len(self.fns), device=x.device).argsort(dim=1)
+
+        out = x.clone()
+        for step in range(len(self.fns)):
+            for fn_idx, fn in enumerate(self.fns):
+                mask = order[:, step] == fn_idx
+                if mask.any():
+                    out[mask] = fn(out[mask], factors[fn_idx][mask])
+        return out
+
+
+class BatchRandomResizedCrop:
+    """
+    Same parameters and sampling procedure as `torchvision.transforms.RandomResizedCrop`, vectorized over samples.
+    """
+
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), attempts=10):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.attempts = attempts
+
+    def get_params(self, n, height, width, device):
+        area = height * width
+        target_area = area * torch.empty(n, self.attempts, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(n, self.attempts, device=device).uniform_(math.log(self.ratio[0]),
+                                                                          math.log(self.ratio[1]))
+        aspect_ratio = torch.exp(log_ratio)
+        w = torch.sqrt(target_area * aspect_ratio).round()
+        h = torch.sqrt(target_area / aspect_ratio).round()
+
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        first = valid.to(torch.uint8).argmax(dim=1, keepdim=True)
+        found = valid.any(dim=1)
+        w = w.gather(1, first).squeeze(1)
+        h = h.gather(1, first).squeeze(1)
+
+        # Fallback to central crop
+        in_ratio = width / height
+        if in_ratio < min(self.ratio):
+            fallback_w = width
+            fallback_h = round(fallback_w / min(self.ratio))
+        elif in_ratio > max(self.ratio):
+            fallback_h = height
+            fallback_w = round(fallback_h * max(self.ratio))
+        else:
+            fallback_w = width
+            fallback_h = height
+
+        w = torch.where(found, w, torch.full_like(w, fallback_w))
+        h = torch.where(found, h, torch.full_like(h, fallback_h))
+        top = torch.floor(torch.rand(n, device=device) * (height - h + 1))
+        left = torch.floor(torch.rand(n, device=device) * (width - w + 1))
+        top = torch.where(found, top, torch.div(height - h, 2, rounding_mode='floor'))
+        left = torch.where(found, left, torch.div(width - w, 2, rounding_mode='floor'))
+        return top, left, h, w
+
+    def __call__(self, x):
+        n, _, height, width = x.shape
+        top, left, h, w = self.get_params(n, height, width, x.device)
+        return _crop_resize(x, top.to(x.dtype), left.to(x.dtype), h.to(x.dtype), w.to(x.dtype), self.size)
+
+
+class BatchRandomHorizontalFlip:
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        mask = torch.rand(x.shape[0], device=x.device) < self.p
+        return torch.where(mask.view(-1, 1, 1, 1), x.flip(-1), x)
+
+
+class BatchRandomGrayscale:
+    def __init__(self, p=0.1):
+        self.p = p
+
+    def __call__(self, x):
+        mask = torch.rand(x.shape[0], device=x.device) < self.p
+        return torch.where(mask.view(-1, 1, 1, 1), _rgb_to_grayscale(x).expand_as(x), x)
+
+
+class BatchRandomGaussianBlur:
+    """
+    Equivalent of `RandomApply([GaussianBlur(kernel_size, sigma)], p)`. Per-sample kernels are applied as one
+    separable, grouped convolution.
+    """
+
+    def __init__(self, kernel_size=5, sigma=(0.1, 2.0), p=0.3):
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.p = p
+
+    def __call__(self, x):
+        mask = torch.rand(x.shape[0], device=x.device) < self.p
+        if not mask.any():
+            return x
+
+        sub = x[mask]
+        m, c, h, w = sub.shape
+        half = (self.kernel_size - 1) // 2
+        sigma = _uniform(m, self.sigma[0], self.sigma[1], x.device)
+        coords = torch.linspace(-half, half, self.kernel_size, dtype=x.dtype, device=x.device)
+        kernel = torch.exp(-0.5 * (coords.unsqueeze(0) / sigma.unsqueeze(1)) ** 2)
+        kernel = (kernel / kernel.sum(dim=1, keepdim=True)).repeat_interleave(c, dim=0)
+
+        flat = F.pad(sub.reshape(1, m * c, h, w), [half, half, half, half], mode='reflect')
+        flat = F.conv2d(flat, kernel.view(m * c, 1, 1, self.kernel_size), groups=m * c)
+        flat = F.conv2d(flat, kernel.view(m * c, 1, self.kernel_size, 1), groups=m * c)
+
+        out = x.clone()
+        out[mask] = flat.view(m, c, h, w)
+        return out
+
+
+class BatchResize:
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, x):
+        if x.shape[-2:] == (self.size, self.size):
+            return x
+        return F.interpolate(x, size=(self.size, self.size), mode='bilinear', align_corners=False, antialias=True)
+
+
+class BatchNormalize:
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, x):
+        return (x - self.mean.to(x.device, x.dtype)) / self.std.to(x.device, x.dtype)
+
+
+def parse_batch_transform(transform: str, image_size=224):
+    """
+    Batched counterpart of `datasets.transforms.parse_transform`. Returns None for transforms that are no-ops on
+    decoded tensors (i.e., `ToTensor`).
+    """
+    if transform == 'ToTensor':
+        return None
+    elif transform == 'RandomColorJitter':
+        return BatchColorJitter(0.4, 0.4, 0.4)
+    elif transform == 'RandomGrayscale':
+        return BatchRandomGrayscale(p=0.1)
+    elif transform == 'RandomGaussianBlur':
+        return BatchRandomGaussianBlur(kernel_size=5, p=0.3)
+    elif transform == 'Normalize':
+        return BatchNormalize(mean=NORMALIZE_MEAN, std=NORMALIZE_STD)
+    elif transform == 'Resize':
+        return BatchResize(image_size)
+    elif transform == 'RandomHorizontalFlip':
+        return BatchRandomHorizontalFlip()
+    elif transform == 'RandomResizedCrop':
+        return BatchRandomResizedCrop(image_size)
+
+    # Aug Intensity
+    elif transform == 'RCrop_stronger':
+        return BatchRandomResizedCrop(image_size, scale=(0.01, 1.0))
+    elif transform == 'RCrop_strong':
+        return BatchRandomResizedCrop(image_size, scale=(0.3, 1.0))
+    elif transform == 'RCrop_weak':
+        return BatchRandomResizedCrop(image_size, scale=(0.6, 1.0))
+    elif transform == 'RCrop_weaker':
+        return BatchRandomResizedCrop(image_size, scale=(0.9, 1.0))
+
+    elif transform == 'CJitter_stronger':
+        return BatchColorJitter((0.2, 1.8), (0.2, 1.8), (0.2, 1.8))
+    elif transform == 'CJitter_strong':
+        return BatchColorJitter((0.4, 1.6), (0.4, 1.6), (0.4, 1.6))
+    elif transform == 'CJitter_weak':
+        return BatchColorJitter((0.6, 1.4), (0.6, 1.4), (0.6, 1.4))
+    elif transform == 'CJitter_weaker':
+        return BatchColorJitter((0.8, 1.2), (0.8, 1.2), (0.8, 1.2))
+    else:
+        raise ValueError('Unsupported batch transform: {}'.format(transform))
+
+
+def get_batch_transform(augmentation: str = None, image_size=224) -> BatchCompose:
+    transform_list = get_transform_list(augmentation)
+    transform_funcs = [parse_batch_transform(x, image_size=image_size) for x in transform_list]
+    return BatchCompose([t for t in transform_funcs if t is not None])
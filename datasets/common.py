@@ -4,18 +4,37 @@ import torch
 import torchvision.transforms as transforms
 from torch.utils.data.dataset import Subset
 
+from datasets.table import get_class_csr, get_sample_class_csr
 from datasets.transforms import parse_transform, get_composed_transform
 
 
+def get_class_indices(dataset, n_classes: int) -> dict:
+    """
+    Per-class sample indices (in sample order) of an `ImageFolder`, or of a dataset with a `labels` array, without
+    decoding any image.
+    """
+    if hasattr(dataset, 'samples'):
+        class_offsets, class_indices = get_sample_class_csr(dataset.samples, n_classes)
+    else:
+        class_offsets, class_indices = get_class_csr(dataset.labels, n_classes)
+    return {cl: class_indices[class_offsets[cl]:class_offsets[cl + 1]] for cl in range(n_classes)}
+
+
 class SubDataset:
-    def __init__(self, sub_meta, cl, transform=transforms.ToTensor(), target_transform=None):
+    def __init__(self, sub_meta, cl, transform=transforms.ToTensor(), target_transform=None, dataset=None):
+        """
+        :param sub_meta: Images of the class, or sample indices into dataset (if given), whose images are then decoded
+                         on access
+        """
         self.sub_meta = sub_meta
         self.cl = cl
         self.transform = transform
         self.target_transform = target_transform
+        self.dataset = dataset
 
     def __getitem__(self, i):
-        img = self.transform(self.sub_meta[i])
+        img = self.sub_meta[i] if self.dataset is None else self.dataset[self.sub_meta[i]][0]
+        img = self.transform(img)
         target = self.cl
         if self.target_transform is not None:
             target = self.target_transform(self.cl)
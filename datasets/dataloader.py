@@ -1,4 +1,6 @@
-from typing import Tuple, MutableMapping
+import math
+from collections import OrderedDict
+from typing import MutableMapping
 from weakref import WeakValueDictionary
 
 import torch
@@ -6,13 +8,21 @@ import torch.utils.data
 from torch.utils.data import Dataset
 
 from datasets.datasets import dataset_class_map
-from datasets.sampler import EpisodicBatchSampler
+from datasets.decode import ReducedLoader, TensorLoader
+from datasets.episode import EpisodeViewDataset, UnifiedEpisodeLoader
+from datasets.fetch import DEFAULT_FETCH_THREADS, ThreadedFetcher
+from datasets.image_cache import SharedImageCache
+from datasets.sampler import EpisodeSampler, EpisodicBatchSampler
 from datasets.split import split_dataset
-from datasets.transforms import get_composed_transform, get_fixed_transform_with_clean, get_fixed_transform
+from datasets.store import MemmapDataset, open_store
+from datasets.transforms import get_composed_transform, get_fixed_transform_with_clean, get_fixed_transform, \
+    MultiViewTransform, get_view_seed
 
-_unlabeled_dataset_cache: MutableMapping[Tuple[str, str, int, bool, int], Dataset] = WeakValueDictionary()
+_unlabeled_dataset_cache: MutableMapping[tuple, Dataset] = WeakValueDictionary()
+_dataset_core_cache: MutableMapping[tuple, Dataset] = WeakValueDictionary()
 
 DEFAULT_IMAGE_SIZE = 224
+IMAGE_BACKENDS = ['pil', 'torchvision']
 
 ### for SSL
 class ToSiamese:
@@ -33,44 +43,245 @@ class ToSiamese:
         return self.transform(img), self.transform2(img)
 
 class TTA_Augmentation:
-    def __init__(self, aug_mode):
+    def __init__(self, aug_mode, uint8=False, tensor_input=False, single_channel=False):
         self.aug_mode = aug_mode
+        self.uint8 = uint8
+        self.tensor_input = tensor_input
+        self.single_channel = single_channel
 
     def __call__(self, img):
-        self.augmented_imgs = get_composed_transform(self.aug_mode)(img)
+        self.augmented_imgs = get_composed_transform(self.aug_mode, uint8=self.uint8, tensor_input=self.tensor_input,
+                                                     single_channel=self.single_channel)(img)
         return self.augmented_imgs 
 
-def get_default_dataset(dataset_name: str, augmentation: str, image_size: int = None, siamese=False, tta=False):
+class EpisodeFetchDataset(Dataset):
     """
-    :param augmentation: One of {'base', 'strong', None, 'none'}
+    Wraps an `ImageFolder`-style dataset for episodic batch samplers, with batched fetching (`__getitems__`): the
+    images of a batch are decoded by `fetch_threads` threads, then transformed in sample order (see `datasets.fetch`).
     """
-    if image_size is None:
-        print('Using default image size: {}'.format(DEFAULT_IMAGE_SIZE))
-        image_size = DEFAULT_IMAGE_SIZE
 
-    try:
-        dataset_cls = dataset_class_map[dataset_name] 
-    except KeyError as e: 
-        raise ValueError('Unsupported dataset: {}'.format(dataset_name)) 
-        
+    def __init__(self, dataset: Dataset, fetch_threads=0):
+        self.dataset = dataset
+        self.fetcher = ThreadedFetcher(fetch_threads)
+
+    def _load_images(self, indices) -> list:
+        paths = [self.dataset.samples[index][0] for index in indices]
+        return self.fetcher.map(self.dataset.loader, paths)
+
+    def _transform(self, img, target):
+        if self.dataset.transform is not None:
+            img = self.dataset.transform(img)
+        if self.dataset.target_transform is not None:
+            target = self.dataset.target_transform(target)
+        return img, target
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        images = self._load_images(indices)
+        return [self._transform(img, self.dataset.samples[index][1]) for index, img in zip(indices, images)]
+
+    def __len__(self):
+        return len(self.dataset)
+
+class EpisodeCachedDataset(EpisodeFetchDataset):
+    """
+    Wraps an `ImageFolder`-style dataset such that each image is decoded only once per episode. The episodic batch
+    sampler yields the same indices for every epoch of an episode, so later epochs only re-apply the (random)
+    transforms on the cached raw images.
+
+    The cache holds at most `capacity` images and evicts the oldest images first. DataLoader workers fetch the epochs
+    of an episode round-robin, so with `shared=True`, the cache is shared by all workers (see `datasets.image_cache`),
+    i.e., an image is decoded once per episode. Otherwise, each process keeps its own cache (e.g., when loading in the
+    main process).
+    """
+
+    def __init__(self, dataset: Dataset, capacity: int, fetch_threads=0, shared=False):
+        super().__init__(dataset, fetch_threads=fetch_threads)
+        self.capacity = capacity
+        self._images = OrderedDict()
+        self.shared_cache = None
+        if shared:
+            self.shared_cache = SharedImageCache(capacity, tensor_images=isinstance(dataset.loader, TensorLoader))
+
+    def _load_images(self, indices) -> list:
+        if self.shared_cache is not None:
+            return self.shared_cache.get(indices, super()._load_images)
+        missing = [index for index in indices if index not in self._images]
+        self._images.update(zip(missing, super()._load_images(missing)))
+        images = [self._images[index] for index in indices]
+        while len(self._images) > self.capacity:
+            self._images.popitem(last=False)
+        return images
+
+class MultiViewDataset(EpisodeFetchDataset):
+    """
+    Wraps an `ImageFolder`-style dataset, such that each fetch decodes an image once and returns all views of a
+    `MultiViewTransform` as a single [n_views, C, H, W] tensor. Indexed by `(episode, index)` pairs (see
+    `EpisodicBatchSampler(with_episode=True)`), so that the views are seeded per episode and sample via `seed`.
+    """
+
+    def __init__(self, dataset: Dataset, transform: MultiViewTransform, seed: int = None, fetch_threads=0):
+        super().__init__(dataset, fetch_threads=fetch_threads)
+        self.transform = transform
+        self.seed = seed
+
+    def __getitems__(self, keys):
+        images = self._load_images([index for _, index in keys])
+        samples = []
+        for (episode, index), img in zip(keys, images):
+            view_seed = get_view_seed(self.seed, episode, index) if self.seed is not None else None
+            samples.append((self.transform(img, seed=view_seed), self.dataset.samples[index][1]))
+        return samples
+
+class TransformView(Dataset):
+    """
+    View of an untransformed (split) dataset with its own transforms. Views with different augmentations share the
+    same dataset core, i.e., sample table and split (see `get_split_dataset_core()`). All other attributes (e.g.,
+    `samples`, `loader`, `classes`) are forwarded to the underlying dataset.
+    """
+
+    def __init__(self, dataset: Dataset, transform=None, target_transform=None):
+        self.dataset = dataset
+        self.transform = transform
+        self.target_transform = target_transform
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not found on the view itself
+        if name == 'dataset' or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, index):
+        img, target = self.dataset[index]
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+    def __len__(self):
+        return len(self.dataset)
+
+def get_transform(augmentation: str, siamese=False, tta=False, uint8=False, image_backend='pil', single_channel=False):
+    tensor_input = image_backend == 'torchvision'
     if tta: # if TTA
-        transform = TTA_Augmentation(augmentation)
+        transform = TTA_Augmentation(augmentation, uint8=uint8, tensor_input=tensor_input,
+                                     single_channel=single_channel)
     else : 
-        transform = get_composed_transform(augmentation)
+        transform = get_composed_transform(augmentation, uint8=uint8, tensor_input=tensor_input,
+                                           single_channel=single_channel)
         if siamese:
             transform = ToSiamese(transform)
+    return transform
 
-    return dataset_cls(transform=transform)
+def get_base_dataset(dataset_name: str, data_store: str = None, draft_size: int = None, image_backend='pil',
+                     single_channel=False):
+    """
+    Dataset without transforms, i.e., yielding decoded PIL images (or uint8 tensors, see image_backend).
+
+    :param draft_size: See `datasets.decode`.
+    :param image_backend: One of {'pil', 'torchvision'}. With 'torchvision', images are decoded with `torchvision.io`
+                          to uint8 tensors (see `datasets.decode.TensorLoader`).
+    :param single_channel: Load the images of a grayscale dataset (e.g., ChestX) with a single channel, such that
+                           decoding and augmentation operate on 1/3 of the data. Images are expanded to 3 channels by
+                           the consumer (see `datasets.transforms.normalize_uint8`).
+    """
+    try:
+        dataset_cls = dataset_class_map[dataset_name] 
+    except KeyError as e: 
+        raise ValueError('Unsupported dataset: {}'.format(dataset_name)) 
+    if image_backend not in IMAGE_BACKENDS:
+        raise ValueError('Unsupported image backend: {}'.format(image_backend))
+    if image_backend == 'torchvision' and (data_store is not None or draft_size is not None):
+        raise ValueError('Image backend {} does not support data stores or reduced decoding'.format(image_backend))
+    if single_channel and not getattr(dataset_cls, 'grayscale', False):
+        raise ValueError('Single-channel loading is not supported for dataset: {}'.format(dataset_name))
+    mode = 'L' if single_channel else 'RGB'
+
+    if data_store is not None:
+        dataset = open_store(data_store)
+        if dataset.name != dataset_cls.name:
+            raise ValueError('Data store {} contains {}, not {}'.format(data_store, dataset.name, dataset_name))
+        if draft_size is not None:
+            if isinstance(dataset, MemmapDataset):
+                raise ValueError('Reduced decoding is not supported by memmap data store {} (images are stored '
+                                 'pre-resized, see image_size of datasets.store.build_store)'.format(data_store))
+            dataset.draft_size = draft_size
+        dataset.image_mode = mode
+        return dataset
+
+    dataset = dataset_cls()
+    if image_backend == 'torchvision':
+        dataset.loader = TensorLoader(mode)
+    elif draft_size is not None or single_channel:
+        dataset.loader = ReducedLoader(draft_size, mode)
+    return dataset
+
+def get_default_dataset(dataset_name: str, augmentation: str, image_size: int = None, siamese=False, tta=False,
+                        data_store: str = None, reduced_decode=False, uint8=False, image_backend='pil',
+                        single_channel=False):
+    """
+    :param augmentation: One of {'base', 'strong', None, 'none'}
+    :param data_store: Directory of a data store (see `datasets.store`) to read from instead of the
+                       original image files.
+    :param reduced_decode: Decode images at reduced resolution, at or above image_size (see `datasets.decode`).
+    :param uint8: Produce uint8 image tensors, to be normalized by the consumer (see `normalize_uint8`).
+    :param image_backend: See `get_base_dataset()`.
+    :param single_channel: See `get_base_dataset()`.
+    """
+    if image_size is None:
+        print('Using default image size: {}'.format(DEFAULT_IMAGE_SIZE))
+        image_size = DEFAULT_IMAGE_SIZE
+
+    dataset = get_base_dataset(dataset_name, data_store=data_store, draft_size=image_size if reduced_decode else None,
+                               image_backend=image_backend, single_channel=single_channel)
+    dataset.transform = get_transform(augmentation, siamese=siamese, tta=tta, uint8=uint8, image_backend=image_backend,
+                                      single_channel=single_channel)
+    return dataset
+
+def get_split_dataset_core(dataset_name: str, unlabeled_ratio: int = 0, seed=1, data_store: str = None,
+                           draft_size: int = None, image_backend='pil', single_channel=False):
+    """
+    Untransformed splits of the dataset, shared by all augmentation variants (see `TransformView`).
+    """
+    cache_key = (dataset_name, unlabeled_ratio, seed, data_store, draft_size, image_backend, single_channel)
+    if cache_key not in _dataset_core_cache:
+        dataset = get_base_dataset(dataset_name, data_store=data_store, draft_size=draft_size,
+                                   image_backend=image_backend, single_channel=single_channel)
+        unlabeled, labeled = split_dataset(dataset, ratio=unlabeled_ratio, seed=seed)
+
+        # Cross-reference so that strong ref persists if either split is currently referenced
+        unlabeled.counterpart = labeled
+        labeled.counterpart = unlabeled
+        _dataset_core_cache[cache_key] = unlabeled
+
+    unlabeled = _dataset_core_cache[cache_key]
+    labeled = unlabeled.counterpart
+
+    return unlabeled, labeled
 
 def get_split_dataset(dataset_name: str, augmentation: str, image_size: int = None, siamese=False, tta=False,
-                      unlabeled_ratio: int = 0, seed=1):
+                      unlabeled_ratio: int = 0, seed=1, data_store: str = None, reduced_decode=False, uint8=False,
+                      image_backend='pil', single_channel=False):
     # If cache details change, just remove the cache – it's not worth the maintenance TBH.
-    cache_key = (dataset_name, augmentation, image_size, siamese, unlabeled_ratio, tta)
+    cache_key = (dataset_name, augmentation, image_size, siamese, unlabeled_ratio, seed, tta, data_store,
+                 reduced_decode, uint8, image_backend, single_channel)
     if cache_key not in _unlabeled_dataset_cache:
-        dataset = get_default_dataset(dataset_name=dataset_name, augmentation=augmentation, image_size=image_size,
-                                      siamese=siamese, tta=tta)
-        unlabeled, labeled = split_dataset(dataset, ratio=unlabeled_ratio, seed=seed)
-        
+        if image_size is None:
+            print('Using default image size: {}'.format(DEFAULT_IMAGE_SIZE))
+            image_size = DEFAULT_IMAGE_SIZE
+        unlabeled_core, labeled_core = get_split_dataset_core(dataset_name, unlabeled_ratio=unlabeled_ratio,
+                                                              seed=seed, data_store=data_store,
+                                                              draft_size=image_size if reduced_decode else None,
+                                                              image_backend=image_backend,
+                                                              single_channel=single_channel)
+        transform = get_transform(augmentation, siamese=siamese, tta=tta, uint8=uint8, image_backend=image_backend,
+                                  single_channel=single_channel)
+        unlabeled = TransformView(unlabeled_core, transform)
+        labeled = TransformView(labeled_core, transform)
+
         # Cross-reference so that strong ref persists if either split is currently referenced
         unlabeled.counterpart = labeled
         labeled.counterpart = unlabeled
@@ -127,12 +338,96 @@ def get_episodic_dataloader(dataset_name: str, n_way: int, n_shot: int, support:
 
 def get_labeled_episodic_dataloader(dataset_name: str, n_way: int, n_shot: int, support: bool, n_episodes=600,
                                     n_query_shot=15, n_epochs=1, augmentation: str = None, image_size: int = None,
-                                    unlabeled_ratio: int = 0, num_workers=4, split_seed=1, episode_seed=0, tta=False):
-
-    unlabeled, labeled = get_split_dataset(dataset_name, augmentation, image_size=image_size, siamese=False, tta=tta,
-                                           unlabeled_ratio=unlabeled_ratio, seed=split_seed)
+                                    unlabeled_ratio: int = 0, num_workers=4, split_seed=1, episode_seed=0, tta=False,
+                                    cache_images=True, data_store: str = None, reduced_decode=False, tta_views=0,
+                                    uint8=False, image_backend='pil', fetch_threads=0, threaded=False,
+                                    single_channel=False, episode_group_size=1):
+    """
+    :param cache_images: Decode each image once per episode when the same episode batch is yielded for multiple
+                         epochs (see `EpisodeCachedDataset`), with a cache shared by the workers.
+    :param data_store: See `get_default_dataset()`.
+    :param reduced_decode: See `get_default_dataset()`.
+    :param tta_views: If set (with `tta=True`), each fetch returns `tta_views` augmented views of an image as a single
+                      tensor (see `MultiViewDataset`), seeded via episode_seed.
+    :param uint8: See `get_default_dataset()`.
+    :param image_backend: See `get_base_dataset()`.
+    :param fetch_threads: Decode the images of each episode batch with this many threads (see `datasets.fetch`).
+    :param threaded: Load in the main process (num_workers is ignored), decoding with `fetch_threads` threads
+                     (`DEFAULT_FETCH_THREADS` if not set), instead of in worker processes.
+    :param single_channel: See `get_base_dataset()`.
+    :param episode_group_size: Yield the epochs of groups of this many episodes interleaved (see
+                               `EpisodicBatchSampler`).
+    """
+    if threaded:
+        num_workers = 0
+        fetch_threads = fetch_threads or DEFAULT_FETCH_THREADS
+    multiview = tta and tta_views > 0
+    unlabeled, labeled = get_split_dataset(dataset_name, augmentation, image_size=image_size, siamese=False,
+                                           tta=tta and not multiview,
+                                           unlabeled_ratio=unlabeled_ratio, seed=split_seed, data_store=data_store,
+                                           reduced_decode=reduced_decode, uint8=uint8, image_backend=image_backend,
+                                           single_channel=single_channel)
 
     sampler = EpisodicBatchSampler(labeled, n_way=n_way, n_shot=n_shot, n_query_shot=n_query_shot,
-                                   n_episodes=n_episodes, support=support, n_epochs=n_epochs, seed=episode_seed)
+                                   n_episodes=n_episodes, support=support, n_epochs=n_epochs, seed=episode_seed,
+                                   with_episode=multiview, group_size=episode_group_size)
+
+    dataset = labeled
+    if multiview:
+        dataset = MultiViewDataset(labeled, MultiViewTransform(labeled.transform, tta_views), seed=episode_seed,
+                                   fetch_threads=fetch_threads)
+    elif cache_images and n_epochs > 1:
+        # The batches in flight (2 per worker) may span several episodes, which must all fit into the cache
+        episodes_in_flight = episode_group_size + math.ceil(2 * num_workers / n_epochs)
+        dataset = EpisodeCachedDataset(labeled,
+                                       capacity=n_way * (n_shot if support else n_query_shot) * episodes_in_flight,
+                                       fetch_threads=fetch_threads, shared=num_workers > 1)
+    elif fetch_threads > 0:
+        dataset = EpisodeFetchDataset(labeled, fetch_threads=fetch_threads)
+
+    return torch.utils.data.DataLoader(dataset, num_workers=num_workers, batch_sampler=sampler, pin_memory=True)
+
+def get_unified_episodic_dataloader(dataset_name: str, n_way: int, n_shot: int, n_episodes=600, n_query_shot=15,
+                                    n_epochs=1, augmentation: str = None, tta_augmentation: str = None,
+                                    n_tta_views=0, image_size: int = None, unlabeled_ratio: int = 0, num_workers=4,
+                                    split_seed=1, episode_seed=0, data_store: str = None, reduced_decode=False,
+                                    tta_multiview=False, uint8=False, image_backend='pil', fetch_threads=0,
+                                    threaded=False, single_channel=False):
+    """
+    Single loader for the support (one view per epoch, with `augmentation`), query (clean) and TTA (`n_tta_views`
+    views, with `tta_augmentation`) views of each episode. See `datasets.episode`.
+
+    :param tta_multiview: Serve all TTA views as a single [w * q, n_tta_views, C, H, W] batch (see
+                          `MultiViewTransform`), seeded via episode_seed.
+    :param uint8: See `get_default_dataset()`.
+    :param image_backend: See `get_base_dataset()`.
+    :param fetch_threads: See `get_labeled_episodic_dataloader()`.
+    :param threaded: See `get_labeled_episodic_dataloader()`.
+    :param single_channel: See `get_base_dataset()`.
+    """
+    if threaded:
+        num_workers = 0
+        fetch_threads = fetch_threads or DEFAULT_FETCH_THREADS
+    unlabeled, labeled = get_split_dataset(dataset_name, None, image_size=image_size, siamese=False,
+                                           unlabeled_ratio=unlabeled_ratio, seed=split_seed, data_store=data_store,
+                                           reduced_decode=reduced_decode, image_backend=image_backend,
+                                           single_channel=single_channel)
+    transform_kwargs = dict(uint8=uint8, tensor_input=image_backend == 'torchvision', single_channel=single_channel)
 
-    return torch.utils.data.DataLoader(labeled, num_workers=num_workers, batch_sampler=sampler, pin_memory=True)
+    episode_sampler = EpisodeSampler(labeled, n_way=n_way, n_shot=n_shot, n_query_shot=n_query_shot,
+                                     n_episodes=n_episodes, seed=episode_seed)
+    tta_transform = get_composed_transform(tta_augmentation, **transform_kwargs) if n_tta_views else None
+    if tta_multiview and n_tta_views:
+        tta_transform = MultiViewTransform(tta_transform, n_tta_views)
+        n_tta_views = 1
+    shared_capacity = None
+    if num_workers > 1:
+        # The tasks in flight (2 per worker) may span several episodes, which must all fit into the cache
+        tasks_per_episode = 1 + n_epochs + n_tta_views
+        shared_capacity = n_way * (n_shot + n_query_shot) * (1 + math.ceil(2 * num_workers / tasks_per_episode))
+    dataset = EpisodeViewDataset(labeled, episode_sampler,
+                                 support_transform=get_composed_transform(augmentation, **transform_kwargs),
+                                 query_transform=get_composed_transform(None, **transform_kwargs),
+                                 tta_transform=tta_transform, fetch_threads=fetch_threads,
+                                 shared_capacity=shared_capacity)
+    return UnifiedEpisodeLoader(dataset, n_support_views=n_epochs, n_tta_views=n_tta_views, num_workers=num_workers)
@@ -7,53 +7,149 @@ import os
 import numpy as np
 import pandas as pd
 from torchvision.datasets import ImageFolder
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader
+from torchvision.datasets.vision import VisionDataset
 
 from configs import *
+from datasets.index import get_directory_fingerprint, get_file_fingerprint, load_sample_index, save_sample_index
+from datasets.table import SampleTable
 
 
-class MiniImageNetDataset(ImageFolder):
+class IndexedImageFolder(ImageFolder):
+    """
+    `ImageFolder` that loads its classes and samples from a persistent index (see `datasets.index`) instead of walking
+    the directory tree, as long as the fingerprint of the data (by default, the directory fingerprint) is unchanged.
+    Subclasses that select data differently override `get_fingerprint`, `scan_classes` and `scan_samples`.
+
+    Samples are kept as a compact `SampleTable` (see `datasets.table`) rather than a list of tuples, and `targets` as
+    the label array of the table. The index is specific to the file filter (`extensions`, `is_valid_file`, identified
+    by its qualified name).
+    """
+
+    grayscale = False  # all images are grayscale, i.e., can be loaded with a single channel
+
+    def __init__(self, root, transform=None, target_transform=None, loader=default_loader, is_valid_file=None,
+                 **kwargs):
+        # As `ImageFolder.__init__`, except that `targets` is the label array of the table instead of a list built
+        # from the samples
+        VisionDataset.__init__(self, root, transform=transform, target_transform=target_transform)
+        self.extensions = IMG_EXTENSIONS if is_valid_file is None else None
+        self.is_valid_file = is_valid_file
+        classes, class_to_idx = self.find_classes(self.root)
+        samples = self.make_dataset(self.root, class_to_idx, self.extensions, is_valid_file, **kwargs)
+
+        self.loader = loader
+        self.classes = classes
+        self.class_to_idx = class_to_idx
+        self.samples = samples
+        self.imgs = samples
+        self.targets = samples.labels
+
+    def get_index_variant(self) -> str:
+        """
+        Key of the file filter that the samples are selected with.
+        """
+        is_valid_file = self.is_valid_file
+        if is_valid_file is not None:
+            is_valid_file = '{}.{}'.format(getattr(is_valid_file, '__module__', None),
+                                           getattr(is_valid_file, '__qualname__', type(is_valid_file).__qualname__))
+        return repr((self.extensions, is_valid_file))
+
+    def get_fingerprint(self, directory):
+        return get_directory_fingerprint(directory)
+
+    def scan_classes(self, directory):
+        return super().find_classes(directory)
+
+    def scan_samples(self, directory, class_to_idx, *args, **kwargs):
+        return super().make_dataset(directory, class_to_idx, *args, **kwargs)
+
+    def find_classes(self, directory):
+        self._fingerprint = self.get_fingerprint(directory)
+        self._index = load_sample_index(self.name, directory, self._fingerprint, self.get_index_variant())
+        if self._index is not None:
+            return self._index.classes, self._index.class_to_idx
+        return self.scan_classes(directory)
+
+    _find_classes = find_classes  # compatibility with earlier versions
+
+    def make_dataset(self, directory, class_to_idx, *args, **kwargs):
+        index = self._index
+        self._index = None  # avoid keeping a second copy of the samples around (e.g., when splitting)
+        if index is not None:
+            return index.samples
+
+        samples = self.scan_samples(directory, class_to_idx, *args, **kwargs)
+        samples = SampleTable.from_samples(samples, n_classes=len(class_to_idx))
+        classes = sorted(class_to_idx, key=class_to_idx.get)
+        save_sample_index(self.name, directory, self._fingerprint, classes, samples, self.get_index_variant())
+        return samples
+
+
+class CSVIndexedImageFolder(IndexedImageFolder):
+    """
+    Base class for datasets whose samples are selected based on a CSV metadata file. The index is keyed by the hash of
+    the CSV file, which is only parsed (lazily, via `metadata`) if the index is missing or outdated.
+    """
+
+    def __init__(self, root, csv_path, *args, **kwargs):
+        self.csv_path = csv_path
+        self._metadata = None
+        super().__init__(root, *args, **kwargs)
+
+    @property
+    def metadata(self) -> pd.DataFrame:
+        if self._metadata is None:
+            self._metadata = pd.read_csv(self.csv_path)
+        return self._metadata
+
+    def get_fingerprint(self, directory):
+        return get_file_fingerprint(self.csv_path)
+
+
+class MiniImageNetDataset(IndexedImageFolder):
     name = "miniImageNet"
 
     def __init__(self, root=miniImageNet_path, *args, **kwargs):
         super().__init__(root=root, *args, **kwargs)
 
 
-class MiniImageNetTestDataset(ImageFolder):
+class MiniImageNetTestDataset(IndexedImageFolder):
     name = "miniImageNet_test"
 
     def __init__(self, root=miniImageNet_test_path, *args, **kwargs):
         super().__init__(root=root, *args, **kwargs)
 
 
-class TieredImageNetDataset(ImageFolder):
+class TieredImageNetDataset(IndexedImageFolder):
     name = "tieredImageNet"
 
     def __init__(self, root=tieredImageNet_path, *args, **kwargs):
         super().__init__(root=root, *args, **kwargs)
 
 
-class TieredImageNetTestDataset(ImageFolder):
+class TieredImageNetTestDataset(IndexedImageFolder):
     name = "tieredImageNet_test"
 
     def __init__(self, root=tieredImageNet_test_path, *args, **kwargs):
         super().__init__(root=root, *args, **kwargs)
 
 
-class CropDiseaseDataset(ImageFolder):
+class CropDiseaseDataset(IndexedImageFolder):
     name = "CropDisease"
 
     def __init__(self, root=CropDisease_path, *args, **kwargs):
         super().__init__(root=os.path.join(root, "dataset", "train"), *args, **kwargs)
 
 
-class EuroSATDataset(ImageFolder):
+class EuroSATDataset(IndexedImageFolder):
     name = "EuroSAT"
 
     def __init__(self, root=EuroSAT_path, *args, **kwargs):
         super().__init__(root, *args, **kwargs)
 
 
-class ISICDataset(ImageFolder):
+class ISICDataset(CSVIndexedImageFolder):
     name = "ISIC"
     """
     Implementation note: functions for finding data files have been customized so that data is selected based on
@@ -62,10 +158,9 @@ class ISICDataset(ImageFolder):
 
     def __init__(self, root=ISIC_path, *args, **kwargs):
         csv_path = os.path.join(root, "ISIC2018_Task3_Training_GroundTruth.csv")
-        self.metadata = pd.read_csv(csv_path)
-        super().__init__(root, *args, **kwargs)
+        super().__init__(root, csv_path, *args, **kwargs)
 
-    def make_dataset(self, root, *args, **kwargs):
+    def scan_samples(self, root, *args, **kwargs):
         paths = np.asarray(self.metadata.iloc[:, 0])
         labels = np.asarray(self.metadata.iloc[:, 1:])
         labels = (labels != 0).argmax(axis=1)
@@ -78,7 +173,7 @@ class ISICDataset(ImageFolder):
 
         return samples
 
-    def find_classes(self, _):
+    def scan_classes(self, _):
         classes = self.metadata.columns[1:].tolist()
         classes.sort()
         class_to_idx = dict()
@@ -86,11 +181,10 @@ class ISICDataset(ImageFolder):
             class_to_idx[cls] = i
         return classes, class_to_idx
 
-    _find_classes = find_classes  # compatibility with earlier versions
-
 
-class ChestXDataset(ImageFolder):
+class ChestXDataset(CSVIndexedImageFolder):
     name = "ChestX"
+    grayscale = True
     """
     Implementation note: functions for finding data files have been customized so that data is selected based on
     the given CSV file.
@@ -105,10 +199,9 @@ class ChestXDataset(ImageFolder):
                             "Pneumothorax"]
         self.labels_maps = {"Atelectasis": 0, "Cardiomegaly": 1, "Effusion": 2, "Infiltration": 3, "Mass": 4,
                             "Nodule": 5, "Pneumothorax": 6}
-        self.metadata = pd.read_csv(csv_path)
-        super().__init__(images_root, *args, **kwargs)
+        super().__init__(images_root, csv_path, *args, **kwargs)
 
-    def make_dataset(self, root, *args, **kwargs):
+    def scan_samples(self, root, *args, **kwargs):
         samples = []
         paths = np.asarray(self.metadata.iloc[:, 0])
         labels = np.asarray(self.metadata.iloc[:, 1])
@@ -122,34 +215,32 @@ class ChestXDataset(ImageFolder):
         samples.sort()
         return samples
 
-    def find_classes(self, _):
+    def scan_classes(self, _):
         return self.used_labels, self.labels_maps
 
-    _find_classes = find_classes  # compatibility with earlier versions
-
 
-class CarsDataset(ImageFolder):
+class CarsDataset(IndexedImageFolder):
     name = "cars"
 
     def __init__(self, root=cars_path, *args, **kwargs):
         super().__init__(root=root, *args, **kwargs)
 
 
-class CUBDataset(ImageFolder):
+class CUBDataset(IndexedImageFolder):
     name = "cub"
 
     def __init__(self, root=cub_path, *args, **kwargs):
         super().__init__(root=root, *args, **kwargs)
 
 
-class PlacesDataset(ImageFolder):
+class PlacesDataset(IndexedImageFolder):
     name = "places"
 
     def __init__(self, root=places_path, *args, **kwargs):
         super().__init__(root=root, *args, **kwargs)
 
 
-class PlantaeDataset(ImageFolder):
+class PlantaeDataset(IndexedImageFolder):
     name = "plantae"
 
     def __init__(self, root=plantae_path, *args, **kwargs):
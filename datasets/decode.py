@@ -0,0 +1,75 @@
+"""
+Reduced-resolution image decoding.
+
+All transform recipes in `datasets.transforms` end at `image_size` (224 px by default), whereas source images of e.g.
+ISIC and ChestX are 1024 px and larger. With reduced decoding, JPEG images are decoded at the smallest DCT scale (1/2,
+1/4 or 1/8) that is still at or above `image_size` in both dimensions (`PIL.Image.draft`), so most of the full-size
+decode is skipped. Formats without reduced-scale decoding (e.g., the PNGs of ChestX) are decoded fully and then
+box-reduced by the largest integer factor that keeps both dimensions at or above `image_size`, so that all subsequent
+transforms operate on the smaller image.
+
+Implementation note: this changes the pixels that `Resize`/`RandomResizedCrop` sample from, so outputs are close to, but
+not identical to, full-resolution decoding. Random crops that cover a small part of the image are upsampled from fewer
+source pixels.
+
+Loaders take an image mode, e.g., 'L' to decode grayscale datasets with a single channel (see `single_channel` in
+`datasets.dataloader.get_base_dataset`).
+
+Alternatively, `TensorLoader` decodes with `torchvision.io` straight to uint8 tensors, without PIL (see the
+`torchvision` image backend in `datasets.dataloader.get_base_dataset`).
+"""
+
+from PIL import Image
+from torchvision.io import ImageReadMode, decode_image, read_file
+
+
+def open_image(fp, draft_size: int = None, mode: str = 'RGB') -> Image.Image:
+    """
+    Equivalent of `torchvision.datasets.folder.pil_loader` (given an open file), optionally with reduced decoding.
+
+    :param mode: Image mode to convert to, i.e., 'RGB' (as `pil_loader`) or 'L'
+    """
+    img = Image.open(fp)
+    if draft_size is None:
+        return img.convert(mode)
+
+    # Reduce the scale only, in the mode of the file (e.g., 'L' for grayscale JPEGs), and convert as without draft
+    img.draft(img.mode, (draft_size, draft_size))
+    img = img.convert(mode)
+    factor = min(img.width // draft_size, img.height // draft_size)
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img
+
+
+class ReducedLoader:
+    """
+    Drop-in replacement for `ImageFolder.loader`, with reduced decoding to `draft_size` (if given) and conversion to
+    `mode`.
+    """
+
+    def __init__(self, draft_size: int = None, mode: str = 'RGB'):
+        self.draft_size = draft_size
+        self.mode = mode
+
+    def __call__(self, path):
+        with open(path, 'rb') as f:
+            return open_image(f, self.draft_size, self.mode)
+
+
+class TensorLoader:
+    """
+    Drop-in replacement for `ImageFolder.loader` that decodes with `torchvision.io` to uint8 tensors [3, H, W].
+    Grayscale, palette and RGBA images (e.g., the PNGs of ChestX) are converted to RGB, like `pil_loader` does. With
+    mode 'L', images are decoded to a single channel [1, H, W] instead.
+    """
+
+    def __init__(self, mode: str = 'RGB'):
+        self.mode = mode
+
+    @property
+    def read_mode(self) -> ImageReadMode:
+        return ImageReadMode.GRAY if self.mode == 'L' else ImageReadMode.RGB
+
+    def __call__(self, path):
+        return decode_image(read_file(path), mode=self.read_mode)
@@ -0,0 +1,154 @@
+"""
+Unified episode loading: the support, query and TTA views of each episode are served by a single data loader (i.e., a
+single dataset, split, sampler and worker pool), instead of one episodic data loader per view.
+
+Each episode is split into tasks (one per support epoch, one for the clean query set and one per TTA view), which are
+distributed over the workers in consumption order, i.e., the tasks of an episode are fetched by all workers. The decoded
+images are cached in shared memory for all workers (see `datasets.image_cache`), so that an image is decoded once per
+episode instead of once per view. Without workers, the main process caches the images of its current episode.
+"""
+
+from typing import Iterator, List, Tuple
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from datasets.decode import TensorLoader
+from datasets.fetch import ThreadedFetcher
+from datasets.image_cache import SharedImageCache
+from datasets.sampler import EpisodeSampler
+from datasets.transforms import MultiViewTransform, get_view_seed
+
+SUPPORT = 'support'
+QUERY = 'query'
+QUERY_TTA = 'query_tta'
+
+
+class EpisodeViewDataset(Dataset):
+    """
+    Map-style dataset indexed by task keys `(view, episode, k)` (with view one of SUPPORT, QUERY, QUERY_TTA). Returns
+    the transformed support or query images of the episode as a batch, i.e., `(images, targets)`. With a
+    `MultiViewTransform` as tta_transform, a single QUERY_TTA task returns all TTA views as [w * q, n_views, C, H, W].
+    """
+
+    def __init__(self, dataset: Dataset, episode_sampler: EpisodeSampler, support_transform, query_transform,
+                 tta_transform=None, fetch_threads=0, shared_capacity: int = None):
+        """
+        :param fetch_threads: Decode the images of each episode with this many threads (see `datasets.fetch`).
+        :param shared_capacity: Cache the decoded images of up to this many samples in shared memory (for data loaders
+                                with several workers), instead of the images of the current episode per process.
+        """
+        self.dataset = dataset
+        self.episode_sampler = episode_sampler
+        self.transforms = {
+            SUPPORT: support_transform,
+            QUERY: query_transform,
+            QUERY_TTA: tta_transform,
+        }
+        self.fetcher = ThreadedFetcher(fetch_threads)
+        self._episode = None
+        self._images = {}
+        self.shared_cache = None
+        if shared_capacity is not None:
+            self.shared_cache = SharedImageCache(shared_capacity,
+                                                 tensor_images=isinstance(dataset.loader, TensorLoader))
+
+    def _load_images(self, indices: List[int]) -> list:
+        paths = [self.dataset.samples[index][0] for index in indices]
+        return self.fetcher.map(self.dataset.loader, paths)
+
+    def _get_images(self, episode: int, indices: List[int]) -> list:
+        if self.shared_cache is not None:
+            return self.shared_cache.get(indices, self._load_images)
+        if episode != self._episode:
+            self._episode = episode
+            self._images = {}
+        missing = [index for index in indices if index not in self._images]
+        if missing:
+            self._images.update(zip(missing, self._load_images(missing)))
+        return [self._images[index] for index in indices]
+
+    def __getitem__(self, key: Tuple[str, int, int]):
+        view, episode, _ = key
+        support, query = self.episode_sampler[episode]
+        indices = (support if view == SUPPORT else query).flatten().tolist()
+        transform = self.transforms[view]
+
+        images = []
+        targets = []
+        for index, img in zip(indices, self._get_images(episode, indices)):
+            if isinstance(transform, MultiViewTransform):
+                img = transform(img, seed=get_view_seed(self.episode_sampler.seed, episode, index))
+            elif transform is not None:
+                img = transform(img)
+            images.append(img)
+            targets.append(self.dataset.samples[index][1])
+        return torch.stack(images), torch.tensor(targets)
+
+    def __len__(self):
+        return len(self.episode_sampler)
+
+
+class Episode:
+    """
+    Views of a single episode, streamed from the underlying data loader: `query` is available right away, whereas
+    `support_views()` (one batch per epoch) and then `query_tta_views()` (one batch per TTA view) must be consumed in
+    this order, and completely, before moving on to the next episode. All views are `(images, targets)` batches.
+    """
+
+    def __init__(self, index: int, query, batches: Iterator, n_support_views: int, n_tta_views: int):
+        self.index = index
+        self.query = query
+        self._batches = batches
+        self._remaining = [n_support_views, n_tta_views]
+
+    def _views(self, i):
+        if i == 1 and self._remaining[0] > 0:
+            raise RuntimeError('Support views of episode {} must be consumed before TTA views'.format(self.index))
+        while self._remaining[i] > 0:
+            self._remaining[i] -= 1
+            yield next(self._batches)
+
+    def support_views(self):
+        return self._views(0)
+
+    def query_tta_views(self):
+        return self._views(1)
+
+    def _drain(self):
+        for i in range(len(self._remaining)):
+            for _ in self._views(i):
+                pass
+
+
+class UnifiedEpisodeLoader:
+    """
+    Yields one `Episode` per sampled episode. The episodes are identical to those of the separate episodic data
+    loaders with the same seeds (see `datasets.manifest`).
+    """
+
+    def __init__(self, dataset: EpisodeViewDataset, n_support_views: int, n_tta_views: int, num_workers=4):
+        self.dataset = dataset
+        self.n_episodes = len(dataset)
+        self.n_support_views = n_support_views
+        self.n_tta_views = n_tta_views
+        self.loader = DataLoader(dataset, batch_size=None, sampler=self._get_keys(), num_workers=num_workers,
+                                 pin_memory=True)
+
+    def _get_keys(self) -> List[Tuple[str, int, int]]:
+        keys = []
+        for episode in range(self.n_episodes):
+            keys.append((QUERY, episode, 0))
+            keys.extend((SUPPORT, episode, epoch) for epoch in range(self.n_support_views))
+            keys.extend((QUERY_TTA, episode, k) for k in range(self.n_tta_views))
+        return keys
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        for i in range(self.n_episodes):
+            episode = Episode(i, next(batches), batches, self.n_support_views, self.n_tta_views)
+            yield episode
+            episode._drain()
+
+    def __len__(self):
+        return self.n_episodes
@@ -0,0 +1,60 @@
+"""
+Batched fetching for episodic datasets.
+
+With an episodic batch sampler, a DataLoader worker fetches a whole episode batch (25-75 images for 5-way tasks) per
+request. Datasets that implement `__getitems__` are given the whole batch at once (PyTorch >= 2.0; older versions fall
+back to `__getitem__`), so that its images can be read and decoded concurrently by a small thread pool. File I/O and
+image decoding (libjpeg, libpng, `torchvision.io`) release the GIL, so a few threads per worker are enough to overlap
+them.
+
+Transforms are applied in the calling thread, in sample order, after all images of the batch are decoded. Random
+augmentations thus draw from the RNG in the same order as with serial fetching, i.e., outputs are identical.
+
+With `num_workers=0`, the DataLoader fetches in the main process, so that decoding is done by the thread pool only
+(threaded loader mode). For small episodes (e.g., 5-way 1-shot), this avoids the overhead of worker processes and of
+sending batches between processes.
+
+Note that in threaded loader mode, random augmentations draw from the global RNGs of the main process (e.g., the torch
+CPU RNG), which are also used by fine-tuning (head initialization, `torch.randperm` for MixUp/CutMix). Runs are thus
+deterministic, but do not match runs with worker processes (which have their own RNGs). For the same reason, the
+threaded loader cannot be combined with background prefetching (`datasets.prefetch`), where the augmentations would
+draw from the global RNGs concurrently with the main thread.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List
+
+DEFAULT_FETCH_THREADS = 4
+
+
+class ThreadedFetcher:
+    """
+    Maps a function over items with a thread pool of `n_threads` threads, or serially if `n_threads` is 0. The pool
+    is created lazily per process (e.g., per DataLoader worker), and is never pickled or shared across a fork.
+    """
+
+    def __init__(self, n_threads: int = 0):
+        if n_threads < 0:
+            raise ValueError('Invalid number of fetch threads: {}'.format(n_threads))
+        self.n_threads = n_threads
+        self._pool = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.n_threads, thread_name_prefix='fetch')
+            self._pid = os.getpid()
+        return self._pool
+
+    def map(self, fn: Callable, items: Iterable) -> List:
+        items = list(items)
+        if self.n_threads == 0 or len(items) <= 1:
+            return [fn(item) for item in items]
+        return list(self._get_pool().map(fn, items))
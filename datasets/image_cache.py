@@ -0,0 +1,105 @@
+"""
+Decoded-image cache shared by the DataLoader workers of an episodic dataset.
+
+The episodic batch sampler yields the same episode batch for every epoch of an episode, and the DataLoader dispatches
+consecutive batches to its workers round-robin, i.e., the epochs of an episode are fetched by all workers. A cache per
+worker thus decodes each image once per worker and episode. `SharedImageCache` instead keeps the decoded images in a
+temporary directory in shared memory (`/dev/shm`, if available), as raw uint8 arrays, so that each image is decoded
+once per episode: fetches are serialized by a file lock, i.e., the first worker that fetches an episode decodes its
+images, while the other workers wait for it and then only read the arrays.
+
+Cached images are identical to the decoded ones (PIL images are restored with the same size and mode), so outputs do
+not depend on which worker decoded an image.
+"""
+
+import fcntl
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Callable, List
+
+import numpy as np
+import torch
+from PIL import Image
+
+SHM_DIR = '/dev/shm'
+_LOCK_FILENAME = 'lock'
+_IMAGE_FILENAME = '{}.npy'
+
+
+def _remove_directory(directory: str, owner_pid: int):
+    # Only the process that created the cache removes it, not (forked) DataLoader workers that exit
+    if os.getpid() == owner_pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class SharedImageCache:
+    """
+    Cache of at most `capacity` decoded images (PIL images, or uint8 tensors with `tensor_images`), keyed by sample
+    index and shared by all processes that use (a copy of) the cache object. The oldest images are evicted first. The
+    cache directory is removed with the cache object of the creating process.
+    """
+
+    def __init__(self, capacity: int, tensor_images=False):
+        self.capacity = capacity
+        self.tensor_images = tensor_images
+        self.directory = tempfile.mkdtemp(prefix='image_cache_', dir=SHM_DIR if os.path.isdir(SHM_DIR) else None)
+        self._finalizer = weakref.finalize(self, _remove_directory, self.directory, os.getpid())
+        self._lock_fd = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_finalizer'] = None
+        state['_lock_fd'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_lock(self) -> int:
+        # Opened per process: flock does not exclude processes that share an inherited file description
+        if self._pid != os.getpid():
+            self._lock_fd = os.open(os.path.join(self.directory, _LOCK_FILENAME), os.O_RDWR | os.O_CREAT)
+            self._pid = os.getpid()
+        return self._lock_fd
+
+    def _get_path(self, index: int) -> str:
+        return os.path.join(self.directory, _IMAGE_FILENAME.format(index))
+
+    def _write(self, index: int, img):
+        array = img.numpy() if self.tensor_images else np.asarray(img)
+        path = self._get_path(index)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+
+    def _read(self, index: int):
+        array = np.load(self._get_path(index))
+        return torch.from_numpy(array) if self.tensor_images else Image.fromarray(array)
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.npy')]
+        if len(entries) > self.capacity:
+            entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+            for entry in entries[:len(entries) - self.capacity]:
+                os.remove(entry.path)
+
+    def get(self, indices: List[int], load: Callable[[List[int]], list]) -> list:
+        """
+        :param load: Decodes the images of a list of sample indices, called for the images that are not cached
+        :return: Images of the given sample indices
+        """
+        fd = self._get_lock()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            missing = [index for index in dict.fromkeys(indices) if not os.path.exists(self._get_path(index))]
+            images = dict(zip(missing, load(missing)))
+            for index, img in images.items():
+                self._write(index, img)
+            for index in indices:
+                if index not in images:
+                    images[index] = self._read(index)
+            self._evict()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return [images[index] for index in indices]
@@ -0,0 +1,96 @@
+"""
+Persistent sample indices for `ImageFolder`-based datasets.
+
+Constructing an `ImageFolder` walks the full directory tree, which is slow for large datasets on network storage. The
+resulting class and sample lists are persisted to a binary index per dataset root (in `configs.cache_dir`), which is
+invalidated whenever the modification time or size of the root or of any class directory changes (i.e., whenever files
+are added, removed or renamed). Datasets that select their samples from a metadata file (ISIC, ChestX) are keyed by the
+hash of that file instead.
+"""
+
+import hashlib
+import os
+import uuid
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+import configs
+from datasets.table import SampleTable
+
+INDEX_DIR = os.path.join(configs.cache_dir, 'index')
+
+
+class SampleIndex(NamedTuple):
+    classes: List[str]
+    class_to_idx: Dict[str, int]
+    samples: SampleTable
+
+
+def get_directory_fingerprint(root: str) -> str:
+    """
+    Fingerprint of the root directory and its immediate subdirectories (one `stat` per class directory).
+    """
+    entries = [('.', os.stat(root).st_mtime_ns, os.stat(root).st_size)]
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir():
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    entries.sort()
+    return hashlib.md5(repr(entries).encode()).hexdigest()
+
+
+def get_file_fingerprint(path: str, chunk_size=1 << 20) -> str:
+    """
+    Hash of the contents of a metadata file (e.g., the ground-truth CSV of a dataset).
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_index_path(name: str, root: str, variant: str = '') -> str:
+    """
+    :param variant: Sample selection options of the index (e.g., the file filter), which are part of the key
+    """
+    key = os.path.abspath(root) if not variant else '{}\0{}'.format(os.path.abspath(root), variant)
+    key_hash = hashlib.md5(key.encode()).hexdigest()[:8]
+    return os.path.join(INDEX_DIR, '{}_{}.npz'.format(name, key_hash))
+
+
+def load_sample_index(name: str, root: str, fingerprint: str, variant: str = ''):
+    """
+    :return: SampleIndex, or None if there is no valid index for the given fingerprint
+    """
+    path = get_index_path(name, root, variant)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as index:
+            if str(index['fingerprint']) != fingerprint:
+                return None
+            classes = index['classes'].tolist()
+            samples = SampleTable.from_arrays(index, root=root, n_classes=len(classes))
+    except (OSError, KeyError, ValueError):
+        return None
+
+    class_to_idx = {cls: i for i, cls in enumerate(classes)}
+    return SampleIndex(classes, class_to_idx, samples)
+
+
+def save_sample_index(name: str, root: str, fingerprint: str, classes: List[str],
+                      samples: Sequence[Tuple[str, int]], variant: str = ''):
+    path = get_index_path(name, root, variant)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if not isinstance(samples, SampleTable):
+        samples = SampleTable.from_samples(samples, n_classes=len(classes))
+
+    # Write to a temporary file first, since several jobs may build the same index concurrently
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, fingerprint=np.asarray(fingerprint), classes=np.asarray(classes), **samples.to_arrays(root=root))
+    os.replace(tmp_path, path)
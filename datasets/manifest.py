@@ -0,0 +1,142 @@
+"""
+Episode manifests: the sample indices of every episode for a given labeled split and episode configuration.
+
+A manifest is an int64 array of shape [n_episodes, n_way, n_shot + n_query_shot] (support indices first), indexing
+into the samples of the labeled split. It is generated once and shared by the support, query and TTA samplers, and
+across runs that use the same episodes (e.g., augmentation or lr sweeps). Since the samples of each episode are known
+up front, external processes can also use a manifest to pre-warm caches. Manifests are stored in `configs.cache_dir`.
+
+Episodes are drawn exactly as before manifests were introduced, i.e., runs with the same seeds see the same episodes.
+"""
+
+import argparse
+import hashlib
+import os
+import uuid
+
+import numpy as np
+
+import configs
+from datasets.table import get_class_csr, get_labels, get_paths, get_sample_class_csr
+
+MANIFEST_DIR = os.path.join(configs.cache_dir, 'manifests')
+
+
+def get_split_digest(labels: np.ndarray, n_classes: int, paths: np.ndarray) -> str:
+    """
+    Digest of the samples (labels and paths) of a split, i.e., splits with identical labels but different samples
+    (e.g., of another split seed) have different manifests.
+    """
+    md5 = hashlib.md5(np.ascontiguousarray(labels, dtype=np.int64).tobytes() + str(n_classes).encode())
+    md5.update(np.ascontiguousarray(np.char.encode(paths, 'utf-8')).tobytes())
+    return md5.hexdigest()
+
+
+def get_manifest_path(name: str, n_way: int, n_shot: int, n_query_shot: int, n_episodes: int, seed: int,
+                      digest: str) -> str:
+    basename = '{}_{}way_{}shot_{}query_{}episodes_seed{}_{}.npz'.format(name, n_way, n_shot, n_query_shot,
+                                                                         n_episodes, seed, digest[:8])
+    return os.path.join(MANIFEST_DIR, basename)
+
+
+def generate_episode_manifest(labels: np.ndarray, n_classes: int, n_way: int, n_shot: int, n_query_shot: int,
+                              n_episodes: int, seed: int = 0, class_csr=None) -> np.ndarray:
+    """
+    Each episode is drawn from its own `RandomState` (seeded from `seed`), with a permutation of the classes and then
+    one `choice` per class, exactly as the original sampler did. These draws consume one Mersenne Twister stream per
+    episode in sequence, so they are not vectorized; generation runs once per split and configuration.
+
+    :param labels: Label of each sample in the split
+    :param class_csr: `get_class_csr(labels, n_classes)`, if already computed (e.g., by a `SampleTable`)
+    :return: ndarray[n_episodes, n_way, n_shot + n_query_shot]
+    """
+    k = n_shot + n_query_shot
+
+    # Sample indices grouped by class (in sample order), i.e., class c owns order[offsets[c]:offsets[c + 1]]
+    offsets, order = class_csr if class_csr is not None else get_class_csr(labels, n_classes)
+
+    rs = np.random.RandomState(seed)
+    episode_seeds = [rs.randint(2 ** 32 - 1) for _ in range(n_episodes)]
+
+    episodes = np.empty((n_episodes, n_way, k), dtype=np.int64)
+    for i, episode_seed in enumerate(episode_seeds):
+        rs = np.random.RandomState(episode_seed)
+        selected_aux_classes = rs.permutation(n_classes)[:n_way + 1]
+        selected_classes = selected_aux_classes[:n_way]
+        aux_class = selected_aux_classes[-1]
+        for j, cls in enumerate(selected_classes):
+            # `choice` validates the population size before drawing, so a failed draw does not consume the RNG
+            try:
+                episodes[i, j] = rs.choice(order[offsets[cls]:offsets[cls + 1]], k, replace=False)
+            except ValueError:
+                print(cls)
+                episodes[i, j] = rs.choice(order[offsets[aux_class]:offsets[aux_class + 1]], k, replace=False)
+    return episodes
+
+
+def load_episode_manifest(path: str, digest: str):
+    """
+    :return: ndarray[n_episodes, n_way, n_shot + n_query_shot], or None if there is no valid manifest at path
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as manifest:
+            if str(manifest['digest']) != digest:
+                return None
+            return manifest['episodes']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_episode_manifest(path: str, digest: str, episodes: np.ndarray, paths: np.ndarray):
+    """
+    :param paths: Sample paths of the split, so that manifests can be resolved to files without loading the dataset
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, digest=np.asarray(digest), episodes=episodes, paths=paths)
+    os.replace(tmp_path, path)
+
+
+def get_episode_manifest(dataset, n_way: int, n_shot: int, n_query_shot: int, n_episodes: int,
+                         seed: int = 0) -> np.ndarray:
+    """
+    Loads the manifest for the given dataset (split) and episode configuration, generating it if necessary.
+    """
+    samples = dataset.samples
+    n_classes = len(dataset.classes)
+    labels = get_labels(samples)
+    paths = get_paths(samples)
+    digest = get_split_digest(labels, n_classes, paths)
+    name = getattr(dataset, 'name', type(dataset).__name__)
+    path = get_manifest_path(name, n_way, n_shot, n_query_shot, n_episodes, seed, digest)
+
+    episodes = load_episode_manifest(path, digest)
+    if episodes is None:
+        episodes = generate_episode_manifest(labels, n_classes, n_way, n_shot, n_query_shot, n_episodes, seed,
+                                             class_csr=get_sample_class_csr(samples, n_classes))
+        save_episode_manifest(path, digest, episodes, paths)
+    return episodes
+
+
+if __name__ == '__main__':
+    from datasets.dataloader import get_split_dataset
+
+    parser = argparse.ArgumentParser(description='Generate the episode manifest of a labeled split')
+    parser.add_argument('--dataset', type=str, required=True)
+    parser.add_argument('--n_way', type=int, default=5)
+    parser.add_argument('--n_shot', type=int, default=5)
+    parser.add_argument('--n_query_shot', type=int, default=15)
+    parser.add_argument('--n_episodes', type=int, default=600)
+    parser.add_argument('--unlabeled_ratio', type=int, default=20)
+    parser.add_argument('--split_seed', type=int, default=1)
+    parser.add_argument('--episode_seed', type=int, default=0)
+    args = parser.parse_args()
+
+    _, labeled = get_split_dataset(args.dataset, augmentation=None, unlabeled_ratio=args.unlabeled_ratio,
+                                   seed=args.split_seed)
+    episodes = get_episode_manifest(labeled, args.n_way, args.n_shot, args.n_query_shot, args.n_episodes,
+                                    args.episode_seed)
+    print('Episode manifest: {} ({} images)'.format(episodes.shape, len(np.unique(episodes))))
@@ -0,0 +1,108 @@
+import queue
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, Tuple
+
+from torch.utils.data import DataLoader
+
+
+class PrefetchedEpisode:
+    """
+    Batches of a single episode, streamed from the prefetch queue: `episode[name]` yields the batches of a stream. The
+    streams must be consumed in the order in which they were given to `EpisodePrefetcher` (e.g., the query batch, then
+    the support batches, then the TTA batches). Batches that are not consumed are dropped before the next episode.
+    """
+
+    def __init__(self, index: int, batches: Iterator, batches_per_stream: Dict[str, int]):
+        self.index = index
+        self._batches = batches
+        self._names = list(batches_per_stream)
+        self._remaining = dict(batches_per_stream)
+
+    def _stream(self, name: str):
+        previous = self._names[:self._names.index(name)]
+        while self._remaining[name] > 0:
+            if any(self._remaining[other] > 0 for other in previous):
+                raise RuntimeError('Batches of {} must be consumed before {} (episode {})'.format(
+                    previous, name, self.index))
+            self._remaining[name] -= 1
+            yield next(self._batches)
+
+    def __getitem__(self, name: str):
+        return self._stream(name)
+
+    def _drain(self):
+        for name in self._names:
+            for _ in self._stream(name):
+                pass
+
+
+class EpisodePrefetcher:
+    """
+    Loads the batches of upcoming episodes from several episodic data loaders (e.g., query, support and TTA) in a
+    background thread, so that the batches of the next epochs and episodes are decoded, transformed and pinned while
+    the current ones are being used for fine-tuning.
+
+    Each stream is given as `name: (loader, batches_per_episode)`, where the loaders sample identical episodes (via
+    episode_seed), in the order in which the batches of an episode are consumed. Iterating yields one
+    `PrefetchedEpisode` per episode. All batches pass through a single queue of at most `depth` batches, i.e., memory
+    is bounded by `depth` batches (plus the batches in use), regardless of the number of epochs per episode.
+
+    The loaders must use worker processes: loaders that fetch in the calling thread (threaded loader mode, see
+    `datasets.fetch`) would apply random augmentations with the global RNGs from the background thread.
+    """
+
+    _end = object()
+
+    def __init__(self, streams: Dict[str, Tuple[DataLoader, int]], n_episodes: int, depth: int = 1):
+        if depth < 1:
+            raise ValueError('Invalid prefetch depth: {}'.format(depth))
+        self.streams = OrderedDict(streams)
+        self.n_episodes = n_episodes
+        self.depth = depth
+
+    def _produce(self, iterators, q: queue.Queue, stop: threading.Event):
+        try:
+            for _ in range(self.n_episodes):
+                for name, (_, batches_per_episode) in self.streams.items():
+                    for _ in range(batches_per_episode):
+                        batch = next(iterators[name])
+                        while not stop.is_set():
+                            try:
+                                q.put(batch, timeout=0.1)
+                                break
+                            except queue.Full:
+                                continue
+                        if stop.is_set():
+                            return
+            q.put(self._end)
+        except Exception as e:
+            q.put(e)
+
+    def _consume(self, q: queue.Queue):
+        while True:
+            batch = q.get()
+            if batch is self._end:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+    def __iter__(self):
+        iterators = {name: iter(loader) for name, (loader, _) in self.streams.items()}
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(iterators, q, stop), daemon=True)
+        thread.start()
+        batches = self._consume(q)
+        batches_per_stream = {name: batches_per_episode for name, (_, batches_per_episode) in self.streams.items()}
+        try:
+            for i in range(self.n_episodes):
+                episode = PrefetchedEpisode(i, batches, batches_per_stream)
+                yield episode
+                episode._drain()
+        finally:
+            stop.set()
+
+    def __len__(self):
+        return self.n_episodes
@@ -1,15 +1,17 @@
-from collections import defaultdict
 import math
 import numpy as np
 from torch.utils.data import Sampler
 from torchvision.datasets import ImageFolder
 from itertools import combinations
 
+from datasets.manifest import get_episode_manifest
+
 
 class EpisodeSampler:
     """
     Stable sampler for support and query indices. Used by episodic batch sampler, so that the support and query sets
     can be sampled from independent data loaders using the same splits, i.e., such that support and query do not overlap.
+    Episodes are read from the episode manifest of the dataset (see `datasets.manifest`).
     """
 
     def __init__(self, dataset: ImageFolder, n_way: int, n_shot: int, n_query_shot: int, n_episodes: int,
@@ -24,34 +26,14 @@ class EpisodeSampler:
         self.class_task = math.floor(self.n_classes/self.w)
         self.task_random = np.random.randint(self.class_task)
 
-        rs = np.random.RandomState(seed) 
-        self.episode_seeds = []
-        for i in range(n_episodes):
-            self.episode_seeds.append(rs.randint(2 ** 32 - 1))
-
-        self.indices_by_class = defaultdict(list)
-        for index, (path, label) in enumerate(dataset.samples):
-            self.indices_by_class[label].append(index) 
+        self.episodes = get_episode_manifest(dataset, n_way, n_shot, n_query_shot, n_episodes, seed)
 
     def __getitem__(self, index):
         """
         :param index:
         :return: support: ndarray[w, s], query: ndarray[w ,q]
         """
-        rs = np.random.RandomState(self.episode_seeds[index])
-
-        selected_aux_classes = rs.permutation(self.n_classes)[:self.w+1] 
-        selected_classes = selected_aux_classes[:self.w]
-        aux_class = selected_aux_classes[-1]
-        indices = []
- 
-        for cls in selected_classes: 
-            try : indices.append(rs.choice(self.indices_by_class[cls], self.s + self.q, replace=False)) 
-            except : 
-                print(cls)
-                indices.append(rs.choice(self.indices_by_class[aux_class], self.s + self.q, replace=False))
-        
-        episode = np.stack(indices) 
+        episode = self.episodes[index]
         support = episode[:, :self.s]
         query = episode[:, self.s:] 
         return support, query
@@ -70,7 +52,12 @@ class EpisodicBatchSampler(Sampler):
     """
 
     def __init__(self, dataset: ImageFolder, n_way: int, n_shot: int, n_query_shot: int, n_episodes: int, support: bool,
-                 n_epochs=1, seed=0):
+                 n_epochs=1, seed=0, with_episode=False, group_size=1):
+        """
+        :param with_episode: Yield `(episode, index)` pairs instead of sample indices, e.g., for per-episode seeding.
+        :param group_size: Interleave groups of this many consecutive episodes epoch by epoch, i.e., yield epoch 0 of
+                           each episode of the group, then epoch 1, etc. (e.g., to fine-tune several episodes at once).
+        """
         super().__init__(dataset)
         self.dataset = dataset
 
@@ -82,14 +69,23 @@ class EpisodicBatchSampler(Sampler):
         self.n_episodes = n_episodes
         self.n_epochs = n_epochs
         self.support = support
+        self.with_episode = with_episode
+        self.group_size = group_size
 
     def __len__(self):
         return self.n_episodes * self.n_epochs
 
+    def _get_indices(self, i):
+        support, query = self.episode_sampler[i]
+        indices = support if self.support else query
+        indices = indices.flatten()
+        if self.with_episode:
+            indices = [(i, index) for index in indices.tolist()]
+        return indices
+
     def __iter__(self):
-        for i in range(self.n_episodes):
-            support, query = self.episode_sampler[i]
-            indices = support if self.support else query
-            indices = indices.flatten()
+        for start in range(0, self.n_episodes, self.group_size):
+            group = [self._get_indices(i) for i in range(start, min(start + self.group_size, self.n_episodes))]
             for j in range(self.n_epochs):
-                yield indices
+                for indices in group:
+                    yield indices
@@ -1,12 +1,19 @@
-import copy
+import hashlib
 import os
-from typing import List, Tuple
+import uuid
+from typing import Tuple
 
+import numpy as np
 import pandas as pd
 from numpy.random import RandomState
+from torch.utils.data import Dataset
 from torchvision.datasets import ImageFolder
 
+import configs
+from datasets.table import SampleTable, get_paths
+
 DIRNAME = os.path.dirname(os.path.abspath(__file__))
+SPLIT_INDEX_DIR = os.path.join(configs.cache_dir, 'splits')
 
 DATASETS_WITH_DEFAULT_SPLITS = [
     "miniImageNet",
@@ -20,12 +27,57 @@ DATASETS_WITH_DEFAULT_SPLITS = [
 ]
 
 
+class SplitView(Dataset):
+    """
+    Index view onto a split of `dataset`, used instead of a deep copy of the full dataset. Exposes the `ImageFolder`
+    interface (`samples`, `targets`, ...) of the split; all other attributes (e.g., `transform`, `loader`, `classes`)
+    are forwarded to the underlying dataset.
+    """
+
+    def __init__(self, dataset: ImageFolder, indices: np.ndarray):
+        self.dataset = dataset
+        self.indices = indices
+        self._samples = None
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not found on the view itself
+        if name == 'dataset' or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    @property
+    def samples(self):
+        if self._samples is None:
+            base_samples = self.dataset.samples
+            if isinstance(base_samples, SampleTable):
+                self._samples = base_samples.take(self.indices)
+            else:
+                self._samples = [base_samples[i] for i in self.indices.tolist()]
+        return self._samples
+
+    @property
+    def imgs(self):
+        return self.samples
+
+    @property
+    def targets(self):
+        if isinstance(self.samples, SampleTable):
+            return self.samples.labels
+        return [s[1] for s in self.samples]
+
+    def __getitem__(self, index):
+        return self.dataset[int(self.indices[index])]
+
+    def __len__(self):
+        return len(self.indices)
+
+
 def split_dataset(dataset: ImageFolder, ratio=20, seed=1):
     """
     :param dataset:
     :param ratio: Ratio of unlabeled portion
     :param seed:
-    :return: unlabeled_dataset, labeled_dataset
+    :return: unlabeled_dataset, labeled_dataset (as `SplitView`s of dataset)
     """
     assert (0 <= ratio <= 100)
     unlabeled_path = _get_split_path(dataset, ratio, seed, True)
@@ -35,81 +87,129 @@ def split_dataset(dataset: ImageFolder, ratio=20, seed=1):
         if ratio == 20 and seed == 1 and dataset.name in DATASETS_WITH_DEFAULT_SPLITS and not os.path.exists(path):
             raise Exception("Default split file missing: {}".format(path))
 
+    img_paths = _get_relative_paths(dataset)
+    paths_digest = hashlib.md5(img_paths.tobytes()).hexdigest()
+
     if os.path.exists(unlabeled_path) and os.path.exists(labeled_path):
+        unlabeled_indices = _load_split_indices(unlabeled_path, paths_digest)
+        labeled_indices = _load_split_indices(labeled_path, paths_digest)
+        if unlabeled_indices is not None and labeled_indices is not None:
+            return SplitView(dataset, unlabeled_indices), SplitView(dataset, labeled_indices)
+
         print("Loading unlabeled split from {}".format(unlabeled_path))
         print("Loading labeled split from {}".format(labeled_path))
         unlabeled = _load_split(unlabeled_path)
         labeled = _load_split(labeled_path)
     else:
-        unlabeled, labeled = _get_split(dataset, ratio, seed)
+        unlabeled, labeled = _get_split(img_paths, ratio, seed)
         print("Generating unlabeled split to {}".format(unlabeled_path))
         print("Generating labeled split to {}".format(labeled_path))
         _save_split(unlabeled, unlabeled_path)
         _save_split(labeled, labeled_path)
 
-    ud = copy.deepcopy(dataset)
-    ld = copy.deepcopy(dataset)
+    unlabeled_indices = _apply_split(dataset, img_paths, unlabeled)
+    labeled_indices = _apply_split(dataset, img_paths, labeled)
+    _save_split_indices(unlabeled_indices, unlabeled_path, paths_digest)
+    _save_split_indices(labeled_indices, labeled_path, paths_digest)
 
-    _apply_split(ud, unlabeled)
-    _apply_split(ld, labeled)
+    return SplitView(dataset, unlabeled_indices), SplitView(dataset, labeled_indices)
 
-    return ud, ld
 
+def _get_relative_paths(dataset: ImageFolder) -> np.ndarray:
+    paths = get_paths(dataset.samples)
+    root_with_slash = os.path.join(dataset.root, "")
+    if len(paths) == 0 or not np.char.startswith(paths, root_with_slash).all():
+        return np.char.replace(paths, root_with_slash, "")
 
-def _get_split(dataset: ImageFolder, ratio: int, seed: int) -> Tuple[List[str], List[str]]:
-    img_paths = []
-    for path, label in dataset.samples:
-        root_with_slash = os.path.join(dataset.root, "")
-        img_paths.append(path.replace(root_with_slash, ""))
-    img_paths.sort()
+    # Strip the common root prefix by slicing the fixed-width character buffer
+    width = paths.dtype.itemsize // np.dtype('U1').itemsize
+    chars = paths.view('U1').reshape(len(paths), width)[:, len(root_with_slash):]
+    return np.ascontiguousarray(chars).view('U{}'.format(width - len(root_with_slash))).ravel()
+
+
+def _get_split(img_paths: np.ndarray, ratio: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    img_paths = np.sort(img_paths)
     # Assert uniqueness
-    assert (len(img_paths) == len(set(img_paths)))
+    assert (len(img_paths) == len(np.unique(img_paths)))
 
     rs = RandomState(seed)
     unlabeled_count = len(img_paths) * ratio // 100
-    unlabeled_paths = set(rs.choice(img_paths, unlabeled_count, replace=False))
-    labeled_paths = set(img_paths) - unlabeled_paths
+    unlabeled_paths = np.sort(rs.choice(img_paths, unlabeled_count, replace=False))
+    labeled_paths = np.setdiff1d(img_paths, unlabeled_paths, assume_unique=True)
 
-    return sorted(list(unlabeled_paths)), sorted(list(labeled_paths))
+    return unlabeled_paths, labeled_paths
 
 
-def _save_split(split: List, path):
+def _save_split(split: np.ndarray, path):
     df = pd.DataFrame({
         "img_path": split
     })
     df.to_csv(path)
 
 
-def _load_split(path) -> List[str]: 
+def _load_split(path) -> np.ndarray:
     df = pd.read_csv(path)
-    return df["img_path"].values 
+    return df["img_path"].values.astype(str)
 
 
 def _get_split_path(dataset: ImageFolder, ratio: int, seed=1, unlabeled=True, makedirs=True):
     if unlabeled:
-        basename = '{}_unlabeled_{}.csv'.format(dataset.name, ratio) 
-    else: 
-        basename = '{}_labeled_{}.csv'.format(dataset.name, 100 - ratio) 
+        basename = '{}_unlabeled_{}.csv'.format(dataset.name, ratio)
+    else:
+        basename = '{}_labeled_{}.csv'.format(dataset.name, 100 - ratio)
     path = os.path.join(DIRNAME, 'split_seed_{}'.format(seed), basename)
     if makedirs:
         os.makedirs(os.path.dirname(path), exist_ok=True)
     return path
 
 
-def _apply_split(dataset: ImageFolder, split: List[str]):
-    img_paths = [] 
-    for path, label in dataset.samples: 
-        root_with_slash = os.path.join(dataset.root, "") 
-        img_paths.append(path.replace(root_with_slash, "")) 
+def _get_index_path(split_path: str) -> str:
+    """
+    Binary split (sample indices into the dataset) of the CSV split, in `configs.cache_dir`.
+    """
+    seed_dirname = os.path.basename(os.path.dirname(split_path))  # i.e., split_seed_{seed}
+    basename = os.path.splitext(os.path.basename(split_path))[0] + '.npz'
+    return os.path.join(SPLIT_INDEX_DIR, seed_dirname, basename)
 
-    split_set = set(split) 
-    samples = []
-    for path, sample in zip(img_paths, dataset.samples): 
-        if len(split) > 0 and '.jpg' not in split[0] and dataset.name == 'ISIC': 
-            path = path.replace('.jpg', '')
-        if path in split_set:
-            samples.append(sample) 
 
-    dataset.samples = samples
-    dataset.imgs = samples
-    dataset.targets = [s[1] for s in samples]
+def _get_split_digest(split_path: str, paths_digest: str) -> str:
+    """
+    A binary split is valid as long as neither the dataset samples nor the CSV split have changed.
+    """
+    stat = os.stat(split_path)
+    return '{}_{}_{}'.format(paths_digest, stat.st_mtime_ns, stat.st_size)
+
+
+def _load_split_indices(split_path, paths_digest: str):
+    """
+    :return: Sample indices, or None if the binary split is missing or outdated
+    """
+    path = _get_index_path(split_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as split:
+            if str(split['digest']) != _get_split_digest(split_path, paths_digest):
+                return None
+            return split['indices']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_split_indices(indices: np.ndarray, split_path, paths_digest: str):
+    path = _get_index_path(split_path)
+    digest = _get_split_digest(split_path, paths_digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, indices=indices, digest=np.asarray(digest))
+    os.replace(tmp_path, path)
+
+
+def _apply_split(dataset: ImageFolder, img_paths: np.ndarray, split: np.ndarray) -> np.ndarray:
+    """
+    :return: Indices of the samples of dataset (in dataset order) that belong to the split
+    """
+    if len(split) > 0 and '.jpg' not in split[0] and dataset.name == 'ISIC':
+        img_paths = np.char.replace(img_paths, '.jpg', '')
+    return np.flatnonzero(np.isin(img_paths, split)).astype(np.int64)
@@ -0,0 +1,270 @@
+"""
+Data stores: target datasets converted into a few large files that are faster to read than the original image tree.
+
+A store converts any dataset in `datasets.datasets.dataset_class_map` into one of the following formats, along with
+a label/path index (`paths.npy`, `labels.npy`) in the original sample order:
+- `memmap`: a single uint8 array of pre-resized images (`images.npy`, shape [N, H, W, 3]). The array is
+  memory-mapped on read, so that many processes that fine-tune on the same target dataset share a single page-cache
+  copy instead of decoding JPEGs.
+- `shards`: the original encoded image files, packed into large shard files (`shard_00000.bin`, ...) with an offset
+  index (`locations.npy`, [N, 3] of shard, offset, length). Images are written grouped by class, so that the reads of
+  an episode are local to a few shards. Images are still decoded on read, i.e., outputs are identical to the image
+  tree, but tens of thousands of small-file `open()` calls are replaced by reads from a few open files.
+
+Usage:
+    python -m datasets.store --dataset ISIC --output ./target_data/store/ISIC --image_size 224
+    python -m datasets.store --dataset ChestX --output ./target_data/shards/ChestX --format shards
+
+Implementation note: `memmap` images are stored at a fixed (square) resolution. With `image_size=224`, the `None`
+augmentation (`Resize` to 224x224) yields identical images to the JPEG tree, while `RandomResizedCrop`-based
+augmentations crop from the stored resolution rather than from the original image. Build the store at a larger
+`image_size` (or use `shards`) if this matters for your experiments.
+"""
+
+import argparse
+import io
+import json
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision import transforms
+from tqdm import tqdm
+
+from datasets.datasets import dataset_class_map
+from datasets.decode import open_image
+
+STORE_META_FILENAME = 'store.json'
+SHARD_FILENAME = 'shard_{:05d}.bin'
+
+
+def _get_dataset(dataset_name: str):
+    try:
+        return dataset_class_map[dataset_name]()
+    except KeyError:
+        raise ValueError('Unsupported dataset: {}'.format(dataset_name))
+
+
+def _save_index(dataset, output_dir: str, store_format: str, **kwargs):
+    root_with_slash = os.path.join(dataset.root, "")
+    paths = np.asarray([path.replace(root_with_slash, "") for path, _ in dataset.samples])
+    labels = np.asarray([label for _, label in dataset.samples], dtype=np.int64)
+    np.save(os.path.join(output_dir, 'paths.npy'), paths)
+    np.save(os.path.join(output_dir, 'labels.npy'), labels)
+
+    meta = {
+        'format': store_format,
+        'name': dataset.name,
+        'root': dataset.root,
+        'classes': list(dataset.classes),
+        'class_to_idx': {str(k): int(v) for k, v in dataset.class_to_idx.items()},
+    }
+    meta.update(kwargs)
+    with open(os.path.join(output_dir, STORE_META_FILENAME), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+def build_store(dataset_name: str, output_dir: str, image_size: int = 224):
+    dataset = _get_dataset(dataset_name)
+
+    os.makedirs(output_dir, exist_ok=True)
+    n = len(dataset.samples)
+    resize = transforms.Resize([image_size, image_size])
+
+    images = np.lib.format.open_memmap(os.path.join(output_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(n, image_size, image_size, 3))
+    for i, (path, label) in enumerate(tqdm(dataset.samples, desc='Building store for {}'.format(dataset_name))):
+        images[i] = np.asarray(resize(dataset.loader(path)))
+    images.flush()
+    del images
+
+    _save_index(dataset, output_dir, 'memmap', image_size=image_size)
+    print('Saved store for {} ({} images) to {}'.format(dataset_name, n, output_dir))
+
+
+def build_shards(dataset_name: str, output_dir: str, shard_size: int = 1 << 30):
+    """
+    :param shard_size: Target size of each shard in bytes. A new shard is started once the current one exceeds it.
+    """
+    dataset = _get_dataset(dataset_name)
+
+    os.makedirs(output_dir, exist_ok=True)
+    n = len(dataset.samples)
+    labels = np.asarray([label for _, label in dataset.samples], dtype=np.int64)
+    locations = np.empty((n, 3), dtype=np.int64)
+
+    shard, offset, f = -1, shard_size, None
+    try:
+        # Written grouped by class (in sample order within each class), indexed in the original sample order
+        for i in tqdm(np.argsort(labels, kind='stable'), desc='Building shards for {}'.format(dataset_name)):
+            if offset >= shard_size:
+                if f is not None:
+                    f.close()
+                shard, offset = shard + 1, 0
+                f = open(os.path.join(output_dir, SHARD_FILENAME.format(shard)), 'wb')
+            with open(dataset.samples[i][0], 'rb') as img_file:
+                data = img_file.read()
+            f.write(data)
+            locations[i] = shard, offset, len(data)
+            offset += len(data)
+    finally:
+        if f is not None:
+            f.close()
+
+    np.save(os.path.join(output_dir, 'locations.npy'), locations)
+    _save_index(dataset, output_dir, 'shards', n_shards=shard + 1)
+    print('Saved {} shards for {} ({} images) to {}'.format(shard + 1, dataset_name, n, output_dir))
+
+
+class StoreDataset(Dataset, ABC):
+    """
+    Base class of datasets backed by a data store. Mimics the `ImageFolder` interface (`samples`, `targets`,
+    `classes`, `loader`, ...), so that it can be split and sampled exactly like the datasets in `datasets.datasets`.
+    Sample paths are only used as keys into the store.
+    """
+
+    draft_size = None  # reduced decoding (see `datasets.decode`), only for stores of encoded images (`shards`)
+    image_mode = 'RGB'  # 'L' to load a single channel (see `single_channel` in `datasets.dataloader`)
+
+    def __init__(self, store_dir: str, transform=None, target_transform=None):
+        with open(os.path.join(store_dir, STORE_META_FILENAME)) as f:
+            meta = json.load(f)
+
+        self.store_dir = store_dir
+        self.meta = meta
+        self.name = meta['name']
+        self.root = meta['root']
+        self.classes = meta['classes']
+        self.class_to_idx = meta['class_to_idx']
+        self.transform = transform
+        self.target_transform = target_transform
+
+        paths = np.load(os.path.join(store_dir, 'paths.npy'))
+        labels = np.load(os.path.join(store_dir, 'labels.npy'))
+        self.samples = [(os.path.join(self.root, path), int(label)) for path, label in zip(paths, labels)]
+        self.imgs = self.samples
+        self.targets = [s[1] for s in self.samples]
+        self._rows = {path: row for row, (path, _) in enumerate(self.samples)}
+
+    @abstractmethod
+    def loader(self, path):
+        """
+        :param path: Sample path (see `samples`)
+        :return: Image of the sample, as a PIL image (see `image_mode`)
+        """
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        sample = self.loader(path)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class MemmapDataset(StoreDataset):
+    """
+    Dataset backed by a `memmap` store written by `build_store()`.
+    """
+
+    def __init__(self, store_dir: str, transform=None, target_transform=None):
+        super().__init__(store_dir, transform=transform, target_transform=target_transform)
+        self.image_size = self.meta['image_size']
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened lazily, so that the memmap is never pickled (e.g., sent to DataLoader workers or deep-copied)
+        if self._images is None:
+            self._images = np.load(os.path.join(self.store_dir, 'images.npy'), mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def loader(self, path):
+        img = Image.fromarray(self.images[self._rows[path]])
+        return img if self.image_mode == 'RGB' else img.convert(self.image_mode)
+
+
+class ShardedDataset(StoreDataset):
+    """
+    Dataset backed by a `shards` store written by `build_shards()`. Images are decoded like
+    `torchvision.datasets.folder.pil_loader`, i.e., identically to the original image files.
+    """
+
+    def __init__(self, store_dir: str, transform=None, target_transform=None):
+        super().__init__(store_dir, transform=transform, target_transform=target_transform)
+        self.locations = np.load(os.path.join(store_dir, 'locations.npy'))
+        self._files = {}
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        state['_pid'] = None
+        return state
+
+    def __del__(self):
+        for fd in getattr(self, '_files', {}).values():
+            os.close(fd)
+
+    def _get_file(self, shard: int) -> int:
+        # File descriptors are opened lazily per process (e.g., per DataLoader worker), and are never shared
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        fd = self._files.get(shard)
+        if fd is None:
+            fd = os.open(os.path.join(self.store_dir, SHARD_FILENAME.format(shard)), os.O_RDONLY)
+            # Another thread (see `datasets.fetch`) may have opened the same shard in the meantime
+            if self._files.setdefault(shard, fd) != fd:
+                os.close(fd)
+                fd = self._files[shard]
+        return fd
+
+    def loader(self, path):
+        shard, offset, length = self.locations[self._rows[path]].tolist()
+        # pread does not move the file offset, so concurrent reads (e.g., from threads) are safe
+        data = os.pread(self._get_file(shard), length, offset)
+        return open_image(io.BytesIO(data), self.draft_size, self.image_mode)
+
+
+_store_class_map = {
+    'memmap': MemmapDataset,
+    'shards': ShardedDataset,
+}
+
+
+def open_store(store_dir: str, transform=None, target_transform=None) -> Dataset:
+    meta_path = os.path.join(store_dir, STORE_META_FILENAME)
+    if not os.path.exists(meta_path):
+        raise ValueError('Invalid data store (missing {}): {}'.format(STORE_META_FILENAME, store_dir))
+    with open(meta_path) as f:
+        store_format = json.load(f)['format']
+    if store_format not in _store_class_map:
+        raise ValueError('Unsupported data store format: {}'.format(store_format))
+    return _store_class_map[store_format](store_dir, transform=transform, target_transform=target_transform)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a data store')
+    parser.add_argument('--dataset', required=True, type=str, help='Refer to datasets.datasets.dataset_class_map')
+    parser.add_argument('--output', required=True, type=str, help='Output directory of the store')
+    parser.add_argument('--format', default='memmap', type=str, choices=list(_store_class_map))
+    parser.add_argument('--image_size', default=224, type=int, help='Image size of memmap stores')
+    parser.add_argument('--shard_size', default=1024, type=int, help='Shard size in MB of shards stores')
+    args = parser.parse_args()
+
+    if args.format == 'memmap':
+        build_store(args.dataset, args.output, image_size=args.image_size)
+    else:
+        build_shards(args.dataset, args.output, shard_size=args.shard_size << 20)
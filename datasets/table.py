@@ -0,0 +1,170 @@
+"""
+Compact, array-backed sample tables.
+
+`ImageFolder` keeps its samples as a list of `(path, label)` tuples, i.e., several Python objects per sample. Besides
+the memory overhead (hundreds of MB for tieredImageNet), merely reading such a list touches the reference counts of all
+objects, so DataLoader workers gradually copy the pages of the parent process (copy-on-write). `SampleTable` stores the
+same information in a handful of numpy arrays:
+- a table of directory prefixes and an int32 prefix id per sample,
+- the file names as a single UTF-8 byte buffer with int64 offsets,
+- int32 labels, and CSR-style per-class index arrays (`class_offsets`, `class_indices`, see `get_sample_class_csr`).
+
+Samples are materialized as `(path, label)` tuples on access only, so a table can be used wherever `samples` is.
+"""
+
+import os
+from typing import Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+
+def get_class_csr(labels: np.ndarray, n_classes: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: class_offsets: ndarray[n_classes + 1], class_indices: ndarray[n], such that the indices of the samples of
+             class c (in sample order) are class_indices[class_offsets[c]:class_offsets[c + 1]]
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if n_classes is None:
+        n_classes = int(labels.max()) + 1 if len(labels) else 0
+    class_indices = np.argsort(labels, kind='stable')
+    class_offsets = np.zeros(n_classes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_classes)[:n_classes], out=class_offsets[1:])
+    return class_offsets, class_indices
+
+
+def get_labels(samples) -> np.ndarray:
+    """
+    Labels of a sample table or of a list of `(path, label)` tuples.
+    """
+    if isinstance(samples, SampleTable):
+        return samples.labels
+    return np.fromiter((label for _, label in samples), dtype=np.int64, count=len(samples))
+
+
+def get_sample_class_csr(samples, n_classes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    `get_class_csr` of the labels of a sample table (precomputed) or of a list of `(path, label)` tuples.
+    """
+    if isinstance(samples, SampleTable) and len(samples.class_offsets) == n_classes + 1:
+        return samples.class_offsets, samples.class_indices
+    return get_class_csr(get_labels(samples), n_classes)
+
+
+def get_paths(samples) -> np.ndarray:
+    """
+    Paths (as a numpy string array) of a sample table or of a list of `(path, label)` tuples.
+    """
+    if isinstance(samples, SampleTable):
+        return samples.get_paths()
+    return np.asarray([path for path, _ in samples])
+
+
+class SampleTable(Sequence):
+    """
+    Read-only, array-backed replacement for a list of `(path, label)` tuples (see module docstring).
+    """
+
+    def __init__(self, prefixes: List[str], prefix_ids: np.ndarray, names: np.ndarray, offsets: np.ndarray,
+                 labels: np.ndarray, n_classes: int = None):
+        self.prefixes = list(prefixes)
+        self.prefix_ids = np.asarray(prefix_ids, dtype=np.int32)
+        self.names = np.asarray(names, dtype=np.uint8)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.class_offsets, self.class_indices = get_class_csr(self.labels, n_classes)
+
+    @classmethod
+    def from_samples(cls, samples: Iterable[Tuple[str, int]], n_classes: int = None):
+        prefix_to_id = {}
+        prefix_ids = []
+        names = []
+        labels = []
+        for path, label in samples:
+            prefix, name = os.path.split(path)
+            prefix_ids.append(prefix_to_id.setdefault(prefix, len(prefix_to_id)))
+            names.append(name.encode())
+            labels.append(label)
+
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(name) for name in names), dtype=np.int64, count=len(names)), out=offsets[1:])
+        names = np.frombuffer(b''.join(names), dtype=np.uint8)
+        return cls(list(prefix_to_id), np.asarray(prefix_ids, dtype=np.int32), names, offsets,
+                   np.asarray(labels, dtype=np.int32), n_classes)
+
+    def to_arrays(self, root: str = None) -> dict:
+        """
+        :param root: If given, prefixes are stored relative to root (see `from_arrays`).
+        """
+        prefixes = self.prefixes
+        if root is not None:
+            root_with_slash = os.path.join(root, "")
+            prefixes = ['' if prefix == root else
+                        prefix[len(root_with_slash):] if prefix.startswith(root_with_slash) else prefix
+                        for prefix in prefixes]
+        return {
+            'prefixes': np.asarray(prefixes),
+            'prefix_ids': self.prefix_ids,
+            'names': self.names,
+            'offsets': self.offsets,
+            'labels': self.labels,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, root: str = None, n_classes: int = None):
+        prefixes = arrays['prefixes'].tolist()
+        if root is not None:
+            prefixes = [os.path.join(root, prefix) if prefix else root for prefix in prefixes]
+        return cls(prefixes, arrays['prefix_ids'], arrays['names'], arrays['offsets'], arrays['labels'], n_classes)
+
+    def take(self, indices) -> 'SampleTable':
+        """
+        Sub-table of the given samples (sharing the prefix table).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Gather the name bytes of all selected samples at once
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return SampleTable(self.prefixes, self.prefix_ids[indices], self.names[positions], offsets,
+                           self.labels[indices], len(self.class_offsets) - 1)
+
+    def get_path(self, index: int) -> str:
+        name = self.names[self.offsets[index]:self.offsets[index + 1]].tobytes().decode()
+        return os.path.join(self.prefixes[self.prefix_ids[index]], name)
+
+    def get_paths(self) -> np.ndarray:
+        """
+        Paths of all samples, as a numpy string array (equivalent to `get_path` of each sample, without a per-sample
+        loop in Python).
+        """
+        if len(self) == 0:
+            return np.asarray([], dtype=str)
+        lengths = np.diff(self.offsets)
+        # Scatter the name bytes into a fixed-width [n, max_len] byte matrix, i.e., an array of byte strings
+        matrix = np.zeros((len(self), max(int(lengths.max()), 1)), dtype=np.uint8)
+        rows = np.repeat(np.arange(len(self)), lengths)
+        cols = np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], lengths)
+        matrix[rows, cols] = self.names
+        names = np.char.decode(matrix.view('S{}'.format(matrix.shape[1])).ravel(), 'utf-8')
+        # os.path.join(prefix, name), i.e., with a separator unless the prefix is empty
+        prefixes = np.asarray([os.path.join(prefix, '') for prefix in self.prefixes])
+        return np.char.add(prefixes[self.prefix_ids], names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Sample index out of range: {}'.format(index))
+        return self.get_path(index), int(self.labels[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_path(i), int(self.labels[i])
+
+    def __len__(self):
+        return len(self.labels)
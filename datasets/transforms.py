@@ -1,6 +1,13 @@
+from functools import lru_cache
+from typing import Tuple
+
+import torch
 from torchvision import transforms
 import numpy as np
 
+NORMALIZE_MEAN = [0.485, 0.456, 0.406]
+NORMALIZE_STD = [0.229, 0.224, 0.225]
+
 def parse_transform(transform: str, image_size=224, **transform_kwargs):
     if transform == 'RandomColorJitter':
         return transforms.RandomApply([transforms.ColorJitter(0.4, 0.4, 0.4, 0.0)], p=1.0)
@@ -17,7 +24,9 @@ def parse_transform(transform: str, image_size=224, **transform_kwargs):
             [int(image_size * 1.15),
              int(image_size * 1.15)])
     elif transform == 'Normalize':
-        return transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        return transforms.Normalize(mean=NORMALIZE_MEAN, std=NORMALIZE_STD)
+    elif transform == 'ConvertImageDtype':
+        return transforms.ConvertImageDtype(torch.float)
     elif transform == 'Resize':
         return transforms.Resize(
             [int(image_size),
@@ -79,7 +88,18 @@ def get_fixed_transform(aug_list, image_size=224) -> list:
     return transform_list
 
 
-def get_composed_transform(augmentation: str = None, image_size=224) -> transforms.Compose: 
+def get_transform_list(augmentation: str = None, uint8=False, tensor_input=False, single_channel=False) -> list:
+    """
+    Names of the transforms (see `parse_transform`) that make up each augmentation recipe.
+
+    :param uint8: Produce uint8 tensors (`PILToTensor`) instead of normalized float tensors (`ToTensor`, `Normalize`),
+                  e.g., to reduce the size of batches sent from DataLoader workers. Use `normalize_uint8` on the
+                  consumer side.
+    :param tensor_input: Recipe for uint8 image tensors (see `datasets.decode.TensorLoader`) instead of PIL images,
+                         i.e., `ToTensor` becomes `ConvertImageDtype` (which also scales to [0, 1]).
+    :param single_channel: Recipe for single-channel (grayscale) images, which are normalized and expanded to 3
+                           channels by the consumer (`normalize_uint8`), i.e., without `Normalize`.
+    """
     if augmentation == 'base':
         transform_list = ['RandomColorJitter', 'RandomResizedCrop', 'RandomHorizontalFlip', 'ToTensor',
                           'Normalize']
@@ -89,6 +109,8 @@ def get_composed_transform(augmentation: str = None, image_size=224) -> transfor
 
     elif augmentation is None or augmentation.lower() == 'none':
         transform_list = ['Resize', 'ToTensor', 'Normalize'] 
+    elif augmentation == 'raw':  # decoded but un-normalized images at 1.15x size, e.g., for `datasets.batch_transforms`
+        transform_list = ['Resize_up', 'ToTensor']
 
     elif augmentation == 'rcrop':
         transform_list = ['RandomResizedCrop', 'ToTensor', 'Normalize']
@@ -109,11 +131,94 @@ def get_composed_transform(augmentation: str = None, image_size=224) -> transfor
     else:
         raise ValueError('Unsupported augmentation: {}'.format(augmentation))
 
+    if uint8:
+        transform_list = ['PILToTensor' if x == 'ToTensor' else x for x in transform_list if x != 'Normalize']
+    if tensor_input:
+        transform_list = ['ConvertImageDtype' if x == 'ToTensor' else x for x in transform_list if x != 'PILToTensor']
+    if single_channel:
+        transform_list = [x for x in transform_list if x != 'Normalize']
+    return transform_list
+
+
+def get_composed_transform(augmentation: str = None, image_size=224, uint8=False, tensor_input=False,
+                           single_channel=False) -> transforms.Compose: 
+    transform_list = get_transform_list(augmentation, uint8=uint8, tensor_input=tensor_input,
+                                        single_channel=single_channel)
     transform_funcs = [parse_transform(x, image_size=image_size) for x in transform_list]
     transform = transforms.Compose(transform_funcs)
     return transform
 
 
+@lru_cache(maxsize=None)
+def _get_normalization(dtype: torch.dtype, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    mean = torch.as_tensor(NORMALIZE_MEAN, dtype=dtype, device=device).view(-1, 1, 1)
+    std = torch.as_tensor(NORMALIZE_STD, dtype=dtype, device=device).view(-1, 1, 1)
+    return mean, std
+
+
+def normalize_uint8(x: torch.Tensor, normalize=True, out: torch.Tensor = None) -> torch.Tensor:
+    """
+    Consumer-side counterpart of `ToTensor` and `Normalize` for uint8 batches (see `uint8` in `get_transform_list`),
+    applied in place on the converted tensor with the same ops as torchvision, i.e., with identical results. Tensors
+    that are not uint8 are returned unchanged, except for single-channel batches (see `single_channel` in
+    `get_transform_list`): these are expanded to 3 channels, by broadcasting against the per-channel mean and std,
+    which yields the same tensor as normalizing the 3-channel (RGB) version of the grayscale images.
+
+    :param x: [..., C, H, W]
+    :param normalize: If False, only convert to float in [0, 1] (i.e., `ToTensor` only, as in the `raw` recipe).
+    :param out: Preallocated [..., 3, H, W] tensor to write the result to, e.g., a reused buffer (see
+                `finetuning.workspace`). The result is always copied to out, with identical values.
+    """
+    single_channel = x.shape[-3] == 1
+    if out is not None:
+        out.copy_(x)  # converts to float, and broadcasts single-channel batches to 3 channels
+        if x.dtype == torch.uint8:
+            out.div_(255)
+        elif not single_channel:
+            return out
+        if not normalize:
+            return out
+        mean, std = _get_normalization(out.dtype, out.device)
+        return out.sub_(mean).div_(std)
+
+    if x.dtype != torch.uint8 and not single_channel:
+        return x
+    if x.dtype == torch.uint8:
+        x = x.float().div_(255)
+    if not normalize:
+        return x.expand(*x.shape[:-3], 3, *x.shape[-2:]) if single_channel else x
+    mean, std = _get_normalization(x.dtype, x.device)
+    if single_channel:
+        return x.sub(mean).div_(std)
+    return x.sub_(mean).div_(std)
+
+
+class MultiViewTransform:
+    """
+    Applies `transform` to an image `n_views` times and returns the views as a single [n_views, C, H, W] tensor, e.g.,
+    for test-time augmentation. If a seed is given (see `get_view_seed`), the views only depend on that seed rather than
+    on the (worker-dependent) state of the global torch RNG.
+    """
+
+    def __init__(self, transform, n_views: int):
+        self.transform = transform
+        self.n_views = n_views
+
+    def __call__(self, img, seed: int = None):
+        if seed is None:
+            return torch.stack([self.transform(img) for _ in range(self.n_views)])
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            return torch.stack([self.transform(img) for _ in range(self.n_views)])
+
+
+def get_view_seed(seed: int, episode: int, index: int) -> int:
+    """
+    Seed for the augmented views of sample `index` in `episode`, derived from the episode seed.
+    """
+    return int(np.random.SeedSequence([seed, episode, index]).generate_state(1)[0])
+
+
 # get 4 corner points of patches for CutMix
 def rand_bbox(size, lam):
     W = size[2] 
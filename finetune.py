@@ -7,8 +7,15 @@ import torch.nn as nn
 import itertools
 from backbone import get_backbone_class
 import backbone
+from datasets.batch_transforms import get_batch_transform
 from datasets.dataloader import get_episodic_dataloader, get_labeled_episodic_dataloader
-from datasets.transforms import rand_bbox
+from datasets.prefetch import EpisodePrefetcher
+from datasets.transforms import normalize_uint8
+from finetuning.ensemble import EnsembleFinetuner
+from finetuning.mix import draw_epoch_plan
+from finetuning.probe import BatchedProbe, can_cache_features, encode, train_probe
+from finetuning.reset import ModelSnapshot, ModuleInitializer, ResettableSGD
+from finetuning.workspace import EpisodeWorkspace
 from io_utils import parse_args
 from model import get_model_class
 from model.classifier_head import get_classifier_head_class
@@ -67,13 +74,47 @@ def main(params):
     # Dataloaders
     # Note that both dataloaders sample identical episodes, via episode_seed
     support_epochs = n_epoch
+    support_augmentation = params.ft_augmentation
+    batch_transform = None
+    if params.ft_batch_augmentation:
+        # Support set is decoded once per episode and augmented on the main process every epoch
+        batch_transform = get_batch_transform(params.ft_augmentation)
+        support_epochs = 1
+        support_augmentation = 'raw'
+    cache_features = (params.ft_cache_features or params.ft_probe_solver is not None) and can_cache_features(params)
+    if params.ft_probe_solver is not None and not (cache_features and params.ft_head == 'linear'):
+        raise ValueError('Probe solver {} requires --ft_parts head, a linear head, no augmentation and no '
+                         'v_score'.format(params.ft_probe_solver))
+    if params.ft_cache_features and not cache_features:
+        print('Feature caching requires --ft_parts head without augmentation or v_score. Fine-tuning on images '
+              'instead.')
+    if cache_features:
+        # Support images are identical in every epoch, so they are loaded once per episode
+        support_epochs = 1
+    if params.ft_unified_loader:
+        raise ValueError('--ft_unified_loader is only supported by finetune_da_tta.py')
+    if params.ft_threaded_loader and params.ft_prefetch_depth > 0:
+        # Augmentations would draw from the global RNGs in the prefetch thread, concurrently with the main thread
+        raise ValueError('--ft_prefetch_depth is not supported with --ft_threaded_loader')
+    if params.ft_ensemble > 0 and (params.ft_parts == 'head' or params.v_score or batch_transform is not None or
+                                   params.ft_prefetch_depth > 0):
+        raise ValueError('Ensemble fine-tuning requires a trainable body, and no v_score, batch augmentation or '
+                         'prefetching (use --ft_probe_solver to fine-tune heads only)')
     support_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=True,
                                                      n_query_shot=q, n_episodes=n_episodes, n_epochs=support_epochs,
-                                                     augmentation=params.ft_augmentation,
+                                                     augmentation=support_augmentation,
                                                      unlabeled_ratio=0,
                                                      num_workers=params.num_workers,
                                                      split_seed=params.split_seed,
-                                                     episode_seed=params.ft_episode_seed)
+                                                     episode_seed=params.ft_episode_seed,
+                                                     data_store=params.ft_data_store,
+                                                     reduced_decode=params.ft_reduced_decode,
+                                                     uint8=params.ft_uint8_transport,
+                                                     image_backend=params.ft_image_backend,
+                                                     fetch_threads=params.ft_fetch_threads,
+                                                     threaded=params.ft_threaded_loader,
+                                                     single_channel=params.ft_single_channel,
+                                                     episode_group_size=max(params.ft_ensemble, 1))
 
     query_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=False,
                                                    n_query_shot=q, n_episodes=n_episodes, n_epochs=1,
@@ -81,14 +122,27 @@ def main(params):
                                                    unlabeled_ratio=0,
                                                    num_workers=params.num_workers,
                                                    split_seed=params.split_seed,
-                                                   episode_seed=params.ft_episode_seed)
+                                                   episode_seed=params.ft_episode_seed,
+                                                   data_store=params.ft_data_store,
+                                                   reduced_decode=params.ft_reduced_decode,
+                                                   uint8=params.ft_uint8_transport,
+                                                   image_backend=params.ft_image_backend,
+                                                   fetch_threads=params.ft_fetch_threads,
+                                                   threaded=params.ft_threaded_loader,
+                                                   single_channel=params.ft_single_channel)
 
     assert (len(support_loader) == n_episodes * support_epochs)
     assert (len(query_loader) == n_episodes)
 
-    support_iterator = iter(support_loader)
     support_batches = math.ceil(n_data / bs)
-    query_iterator = iter(query_loader)
+    if params.ft_prefetch_depth > 0:
+        # Streams in consumption order: the query batch, then the support batches of all epochs
+        prefetcher = EpisodePrefetcher({'query': (query_loader, 1), 'support': (support_loader, support_epochs)},
+                                       n_episodes=n_episodes, depth=params.ft_prefetch_depth)
+        episode_iterator = iter(prefetcher)
+    else:
+        support_iterator = iter(support_loader)
+        query_iterator = iter(query_loader)
 
     # Output (history, params)
     train_history_path = get_ft_train_history_path(output_dir)
@@ -163,6 +217,7 @@ def main(params):
 
     mix_bool = (params.ft_mixup or params.ft_cutmix)
     # for cutmix or mixup (between class option)
+    class_shuffled = None
     if mix_bool:
         all_cases = list(itertools.permutations(list(range(w))))
         class_shuffled = all_cases
@@ -172,15 +227,53 @@ def main(params):
                     class_shuffled.remove(case)
                     break
 
+    batched_probe = None
+    if params.ft_probe_solver is not None:
+        # Heads of all episodes are trained at once, after the loop
+        batched_probe = BatchedProbe(params.ft_probe_solver, n_epoch, bs, params.ft_lr,
+                                     intermediate_test=params.ft_intermediate_test,
+                                     clip_grad_norm=1. if 'vit' in params.backbone else None)
+
+    ensemble = None
+    if params.ft_ensemble > 0:
+        # Groups of ft_ensemble episodes are fine-tuned at once (the support loader interleaves their epochs)
+        ensemble = EnsembleFinetuner(params, torch_pretrained, n_epoch, bs, params.ft_lr,
+                                     clip_grad_norm=1. if 'vit' in params.backbone else None)
+
+    # Fast reset: the models and optimizer of the first episode are reset in place for later episodes
+    fast_reset = params.ft_fast_reset is not None
+    body_snapshot = None
+    body_init = None
+    head_init = None
+    optimizer = None
+    criterion = nn.CrossEntropyLoss().cuda()
+    reset_time = 0.
+    # Support, query, augmentation and label tensors, reused for all episodes and epochs
+    workspace = EpisodeWorkspace(w, s, q, bs)
+
     # For each episode
     for episode in range(n_episodes):
+        if params.ft_prefetch_depth > 0:
+            episode_batches = next(episode_iterator)
+            support_iterator = iter(episode_batches['support'])
+            query_iterator = iter(episode_batches['query'])
+
         # Reset models for each episode
-        if not torch_pretrained:
+        reset_start = time.time()
+        if body_snapshot is not None:
+            if body_init is not None:
+                # The wrapper is built once: replay the random draws of its own modules, as if rebuilt
+                body_init.reset()
+            body_snapshot.restore()
+        elif not torch_pretrained:
             body.load_state_dict(copy.deepcopy(state), strict=True)  # note, override model.load_state_dict to change this behavior.
         else:
             body = get_model_class(params.model)(copy.deepcopy(backbone), params)
-                           
-        head = get_classifier_head_class(params.ft_head)(feature_dim, params.n_way, params)  
+
+        if head_init is not None:
+            head_init.reset()
+        else:
+            head = get_classifier_head_class(params.ft_head)(feature_dim, params.n_way, params)
 
         body.cuda()
         head.cuda()
@@ -193,22 +286,34 @@ def main(params):
             ft_body_lr = params.ft_lr
             ft_head_lr = params.ft_lr
 
-        opt_params = []
-        opt_params.append({'params': head.parameters(), 'lr': ft_head_lr, 'momentum' : 0.9, 'dampening' : 0.9, 'weight_decay' : 0.001})
-        opt_params.append({'params': body.parameters(), 'lr': ft_body_lr, 'momentum' : 0.9, 'dampening' : 0.9, 'weight_decay' : 0.001})
-        
-        optimizer = torch.optim.SGD(opt_params)
-        criterion = nn.CrossEntropyLoss().cuda()
+        if fast_reset and optimizer is not None:
+            optimizer.reset([head.parameters(), body.parameters()])
+        else:
+            opt_params = []
+            opt_params.append({'params': head.parameters(), 'lr': ft_head_lr, 'momentum' : 0.9, 'dampening' : 0.9, 'weight_decay' : 0.001})
+            opt_params.append({'params': body.parameters(), 'lr': ft_body_lr, 'momentum' : 0.9, 'dampening' : 0.9, 'weight_decay' : 0.001})
+            optimizer = (ResettableSGD if fast_reset else torch.optim.SGD)(opt_params)
+
+        if fast_reset and body_snapshot is None:
+            body_snapshot = ModelSnapshot(body, device='cuda' if params.ft_fast_reset == 'device' else None,
+                                          modes=torch_pretrained)
+            if torch_pretrained:
+                body_init = ModuleInitializer(body, exclude=body.backbone)
+            head_init = ModuleInitializer(head)
+            print('Captured pretrained body snapshot ({:.1f} MB)'.format(body_snapshot.nbytes() / 2 ** 20))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        reset_time += time.time() - reset_start
 
         x_support = None
         f_support = None
-        y_support = torch.arange(w).repeat_interleave(s).cuda()
-        y_support_np = y_support.cpu().numpy()
+        y_support = workspace.y_support
+        y_support_np = workspace.y_support_np
 
-        x_query = next(query_iterator)[0].cuda()
-        y_query = torch.arange(w).repeat_interleave(q).cuda() 
+        x_query = workspace.load_query(next(query_iterator)[0])
+        y_query = workspace.y_query
         f_query = None
-        y_query_np = y_query.cpu().numpy()
+        y_query_np = workspace.y_query_np
         
         train_acc_history = []
         train_loss_history = []
@@ -220,6 +325,8 @@ def main(params):
         if s != 1:
             support_v_score.append(0.0)
 
+        # Eval-mode query features can be reused as cached features (a freshly built body is in train mode)
+        query_features_eval = not any(m.training for m in body.modules())
         with torch.no_grad():
             f_query = body_forward(x_query, body, backbone, torch_pretrained, params)
             f_query_np = f_query.cpu().numpy()
@@ -227,136 +334,133 @@ def main(params):
             cluster_pred = kmeans.fit(f_query_np).labels_
             query_v_score.append(v_measure_score(cluster_pred, y_query_np))
 
-        # For each epoch
-        for epoch in range(n_epoch):
-            if params.ft_parts == "head" or params.ft_parts == "bn_full":
-                body.eval()
-            else:
-                body.train()
-            head.train()
-
-            aug_bool = mix_bool or params.ft_augmentation
-            if params.ft_scheduler_end is not None: # if augmentation is scheduled
-                aug_bool = (epoch < params.ft_scheduler_end and epoch >= params.ft_scheduler_start) and aug_bool
-
-            x_support = next(support_iterator)[0].cuda()
-
-            total_loss = 0
-            correct = 0
-            indices = np.random.permutation(w * s) 
-
-            if aug_bool:
-                x_support_aug = copy.deepcopy(x_support)
-                if mix_bool:
-                    if params.ft_mixup:
-                        mode = params.ft_mixup
-                    elif params.ft_cutmix:
-                        mode = params.ft_cutmix
-                    else:
-                        raise ValueError ("Unknown mode: %s" % mode)
-                    
-                    lam = np.random.beta(1.0, 1.0)
+        if batch_transform is not None:
+            x_support_raw = normalize_uint8(next(support_iterator)[0].cuda(), normalize=False)
+
+        if ensemble is not None:
+            # Draw the random choices of all epochs now, in the same order as sequential fine-tuning
+            support_shape = (n_data,) + tuple(x_query.shape[1:])
+            plans = [draw_epoch_plan(params, epoch, w, s, support_shape, class_shuffled) for epoch in range(n_epoch)]
+            ensemble.add_episode(body, head, x_query.clone(), y_support, y_query, plans)
+            body.eval()  # as after the last epoch of sequential fine-tuning
+            if len(ensemble) < params.ft_ensemble and episode < n_episodes - 1:
+                continue
+
+            group = list(range(episode + 1 - len(ensemble), episode + 1))
+            support_stream = (torch.stack([normalize_uint8(next(support_iterator)[0].cuda()) for _ in group])
+                              for _ in range(n_epoch))
+            group_train_acc, group_train_loss, group_test_acc = ensemble.run(support_stream)
+            for k, group_episode in enumerate(group):
+                df_train.loc[group_episode + 1] = group_train_acc[k]
+                df_test.loc[group_episode + 1] = group_test_acc[k]
+                df_loss.loc[group_episode + 1] = group_train_loss[k]
+                fmt = 'Episode {:03d}: train_loss={:6.4f} train_acc={:6.2f} test_acc={:6.2f}'
+                print(fmt.format(group_episode, group_train_loss[k][-1], group_train_acc[k][-1] * 100,
+                                 group_test_acc[k][-1] * 100))
+            df_train.to_csv(train_history_path)
+            df_test.to_csv(test_history_path)
+            df_loss.to_csv(loss_history_path)
+            continue
+
+        if cache_features:
+            # Frozen body without augmentation: train the head on features computed once per episode
+            f_support = encode(workspace.load_support(next(support_iterator)[0]), body, backbone, torch_pretrained,
+                               params)
+            if not query_features_eval:
+                f_query = encode(x_query, body, backbone, torch_pretrained, params)
+            if batched_probe is not None:
+                batched_probe.add_episode(head, f_support, y_support, f_query, y_query)
+                continue
+            train_acc_history, train_loss_history, test_acc_history = \
+                train_probe(head, optimizer, criterion, f_support, y_support, f_query, y_query, n_epoch, bs,
+                            intermediate_test=params.ft_intermediate_test,
+                            clip_grad_norm=1. if 'vit' in params.backbone else None)
+            train_loss = train_loss_history[-1]
+        else:
+            # For each epoch
+            for epoch in range(n_epoch):
+                if params.ft_parts == "head" or params.ft_parts == "bn_full":
+                    body.eval()
+                else:
+                    body.train()
+                head.train()
 
-                    if mode == 'both':
-                        indices_shuffled = torch.randperm(x_support.shape[0])
-                    else:
-                        shuffled = np.array([])
-                        if mode == 'within' :
-                            class_arr = range(w)
-                        elif mode == 'between': 
-                            class_arr_idx = np.random.choice(range(len(class_shuffled)), 1)[0]
-                            class_arr = class_shuffled[class_arr_idx]
-
-                        for clss in class_arr:
-                            shuffled = np.append(shuffled, np.random.permutation(range(clss*s, (clss+1)*s))) 
-                        indices_shuffled = torch.from_numpy(shuffled).long()   
-
-                    # mixup
-                    if params.ft_mixup:
-                        x_support_aug = lam * x_support[:,:,:] + (1. - lam) * x_support[indices_shuffled,:,:]
-                        
-                    # cutmix
-                    elif params.ft_cutmix:
-                        bbx1, bby1, bbx2, bby2 = rand_bbox(x_support.shape, lam) 
-                        x_support_aug[:,:,bbx1:bbx2, bby1:bby2] = x_support[indices_shuffled,:,bbx1:bbx2, bby1:bby2]
-                        lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (x_support.shape[-1] * x_support.shape[-2])) # adjust lambda
-                    
-                    y_shuffled = y_support[indices_shuffled]
-
-            # For each iteration
-            for i in range(support_batches):
-                start_index = i * bs
-                end_index = min(i * bs + bs, w * s)
-                batch_indices = indices[start_index:end_index]
-
-                y_batch = y_support[batch_indices] 
-
-                if aug_bool and mix_bool: 
-                    y_shuffled_batch = y_shuffled[batch_indices]
-
-
-                if aug_bool:
-                    f_batch = body_forward(x_support_aug[batch_indices], body, backbone, torch_pretrained, params)
+                if batch_transform is not None:
+                    x_support = batch_transform(x_support_raw)
                 else:
-                    f_batch = body_forward(x_support[batch_indices], body, backbone, torch_pretrained, params)
+                    x_support = workspace.load_support(next(support_iterator)[0])
 
-                pred = head(f_batch)
+                total_loss = 0
+                correct = 0
+                plan = workspace.draw_plan(params, epoch, x_support.shape, class_shuffled)
+                mix = plan.lam is not None
+                lam = plan.lam
+                # MixUp/CutMix (if enabled for this epoch), in place
+                x_support_aug, y_shuffled = workspace.apply_mix(plan, x_support)
 
-                correct += torch.eq(y_batch, pred.argmax(dim=1)).sum()
+                # For each iteration
+                for i in range(support_batches):
+                    x_batch, y_batch, y_shuffled_batch = workspace.get_batch(x_support_aug, i, y_shuffled)
 
-                if aug_bool and mix_bool:
-                    loss = criterion(pred, y_batch) * lam + criterion(pred, y_shuffled_batch) * (1. - lam)
-                else:
-                    loss = criterion(pred, y_batch)
-
-                optimizer.zero_grad() 
-                loss.backward() 
-                if 'vit' in params.backbone:
-                    if params.ft_parts == 'head':
-                        torch.nn.utils.clip_grad_norm_(head.parameters(), max_norm=1.)
-                    else : 
-                        torch.nn.utils.clip_grad_norm_(chain(body.parameters(), head.parameters()), max_norm=1.)
-                optimizer.step()
-
-                total_loss += loss.item()
-
-            train_loss = total_loss / support_batches
-            train_acc = correct / n_data
-
-            if (epoch+1)%50 == 0 or epoch == n_epoch - 1:
-                body.eval()
-                head.eval()
-
-                # V-measure support
-                if params.v_score and params.n_shot != 1:
-                    with torch.no_grad():
-                        f_support = body_forward(x_support, body, backbone, torch_pretrained, params)
-                    f_support = f_support.cpu().numpy()
-                    kmeans = KMeans(n_clusters = w)
-                    cluster_pred = kmeans.fit(f_support).labels_
-                    support_v_score.append(v_measure_score(cluster_pred, y_support_np))
+                    f_batch = body_forward(x_batch, body, backbone, torch_pretrained, params)
+
+                    pred = head(f_batch)
+
+                    correct += torch.eq(y_batch, pred.argmax(dim=1)).sum()
+
+                    if mix:
+                        loss = criterion(pred, y_batch) * lam + criterion(pred, y_shuffled_batch) * (1. - lam)
+                    else:
+                        loss = criterion(pred, y_batch)
+
+                    optimizer.zero_grad() 
+                    loss.backward() 
+                    if 'vit' in params.backbone:
+                        if params.ft_parts == 'head':
+                            torch.nn.utils.clip_grad_norm_(head.parameters(), max_norm=1.)
+                        else : 
+                            torch.nn.utils.clip_grad_norm_(chain(body.parameters(), head.parameters()), max_norm=1.)
+                    optimizer.step()
+
+                    total_loss += loss.item()
+
+                train_loss = total_loss / support_batches
+                train_acc = correct / n_data
+
+                if (epoch+1)%50 == 0 or epoch == n_epoch - 1:
+                    body.eval()
+                    head.eval()
+
+                    # V-measure support
+                    if params.v_score and params.n_shot != 1:
+                        with torch.no_grad():
+                            f_support = body_forward(x_support, body, backbone, torch_pretrained, params)
+                        f_support = f_support.cpu().numpy()
+                        kmeans = KMeans(n_clusters = w)
+                        cluster_pred = kmeans.fit(f_support).labels_
+                        support_v_score.append(v_measure_score(cluster_pred, y_support_np))
              
-                with torch.no_grad():      
-                    # Query Evaluation                 
-                    f_query = body_forward(x_query, body, backbone, torch_pretrained, params)
-                    pred = head(f_query)
-                    correct = torch.eq(y_query, pred.argmax(dim=1)).sum()
-                test_acc = correct / pred.shape[0]
-
-                # Query V-measure
-                if params.v_score:
-                    f_query = f_query.cpu().numpy()
-                    kmeans = KMeans(n_clusters = w)
-                    cluster_pred = kmeans.fit(f_query).labels_
-                    query_v_score.append(v_measure_score(cluster_pred, y_query_np))
-            else:
-                test_acc = torch.tensor(0)
-                support_v_score.append(0.0)
-                query_v_score.append(0.0)
+                    with torch.no_grad():      
+                        # Query Evaluation                 
+                        f_query = body_forward(x_query, body, backbone, torch_pretrained, params)
+                        pred = head(f_query)
+                        correct = torch.eq(y_query, pred.argmax(dim=1)).sum()
+                    test_acc = correct / pred.shape[0]
+
+                    # Query V-measure
+                    if params.v_score:
+                        f_query = f_query.cpu().numpy()
+                        kmeans = KMeans(n_clusters = w)
+                        cluster_pred = kmeans.fit(f_query).labels_
+                        query_v_score.append(v_measure_score(cluster_pred, y_query_np))
+                else:
+                    test_acc = torch.tensor(0)
+                    support_v_score.append(0.0)
+                    query_v_score.append(0.0)
 
-            train_acc_history.append(train_acc.item())
-            test_acc_history.append(test_acc.item())
-            train_loss_history.append(train_loss)
+                train_acc_history.append(train_acc.item())
+                test_acc_history.append(test_acc.item())
+                train_loss_history.append(train_loss)
 
         df_train.loc[episode + 1] = train_acc_history
         df_train.to_csv(train_history_path)
@@ -375,8 +479,21 @@ def main(params):
         fmt = 'Episode {:03d}: train_loss={:6.4f} train_acc={:6.2f} test_acc={:6.2f}'
         print(fmt.format(episode, train_loss, train_acc_history[-1] * 100, test_acc_history[-1] * 100))
 
+    if batched_probe is not None:
+        print('Training heads of {} episodes with probe solver: {}'.format(n_episodes, params.ft_probe_solver))
+        train_acc_history, train_loss_history, test_acc_history = batched_probe.run()
+        for episode in range(n_episodes):
+            df_train.loc[episode + 1] = train_acc_history[episode]
+            df_test.loc[episode + 1] = test_acc_history[episode]
+            df_loss.loc[episode + 1] = train_loss_history[episode]
+            fmt = 'Episode {:03d}: train_loss={:6.4f} train_acc={:6.2f} test_acc={:6.2f}'
+            print(fmt.format(episode, train_loss_history[episode][-1], train_acc_history[episode][-1] * 100,
+                             test_acc_history[episode][-1] * 100))
+
     fmt = 'Final Results: Acc={:5.2f} Std={:5.2f}'
     print(fmt.format(df_test.mean()[-1] * 100, 1.96 * df_test.std()[-1] / np.sqrt(n_episodes) * 100))
+    print('Model reset: {:.2f} ms/episode ({})'.format(reset_time / n_episodes * 1000,
+                                                      params.ft_fast_reset or 'state dict'))
     end = time.time()
 
     print('Saved history to:')
@@ -8,8 +8,11 @@ import torch.nn.utils as torch_utils
 import itertools
 from backbone import get_backbone_class
 import backbone
-from datasets.dataloader import get_episodic_dataloader, get_labeled_episodic_dataloader
-from datasets.transforms import rand_bbox
+from datasets.batch_transforms import get_batch_transform
+from datasets.dataloader import get_episodic_dataloader, get_labeled_episodic_dataloader, \
+    get_unified_episodic_dataloader
+from datasets.prefetch import EpisodePrefetcher
+from datasets.transforms import normalize_uint8, rand_bbox
 from io_utils import parse_args
 from model import get_model_class
 from model.classifier_head import get_classifier_head_class
@@ -75,42 +78,109 @@ def main(params):
     # Dataloaders
     # Note that both dataloaders sample identical episodes, via episode_seed
     support_epochs = n_epoch
-    support_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=True,
-                                                    n_query_shot=q, n_episodes=n_episodes, n_epochs=support_epochs,
-                                                    augmentation=params.ft_augmentation,
-                                                    unlabeled_ratio=params.unlabeled_ratio,
-                                                    num_workers=params.num_workers,
-                                                    split_seed=params.split_seed,
-                                                    episode_seed=params.ft_episode_seed)
-
-    query_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=False,
-                                                    n_query_shot=q, n_episodes=n_episodes, n_epochs=1,
-                                                    augmentation=None,
-                                                    unlabeled_ratio=params.unlabeled_ratio,
-                                                    num_workers=params.num_workers,
-                                                    split_seed=params.split_seed,
-                                                    episode_seed=params.ft_episode_seed)
+    support_augmentation = params.ft_augmentation
+    batch_transform = None
+    if params.ft_batch_augmentation:
+        if params.ft_unified_loader:
+            raise ValueError('--ft_batch_augmentation is not supported with --ft_unified_loader')
+        # Support set is decoded once per episode and augmented on the main process every epoch
+        batch_transform = get_batch_transform(params.ft_augmentation)
+        support_epochs = 1
+        support_augmentation = 'raw'
+    # With multi-view TTA, all TTA views of a query image are produced by a single fetch
+    tta_views = tta_num_samples[-1] - 1 if params.ft_tta_multiview else 0
+    tta_epochs = 1 if params.ft_tta_multiview else tta_num_samples[-1] - 1
     if params.ft_augmentation is not None:
         tta_augmentation = params.ft_augmentation
     else :
         tta_augmentation = 'base' #TTA without DA
         
-    query_tta_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=False,
-                                                    n_query_shot=q, n_episodes=n_episodes, n_epochs=tta_num_samples[-1]-1, # here, n_epochs should be set to tta augmentation samples #
-                                                    augmentation=tta_augmentation,
-                                                    unlabeled_ratio=params.unlabeled_ratio,
-                                                    num_workers=params.num_workers,
-                                                    split_seed=params.split_seed,
-                                                    episode_seed=params.ft_episode_seed,
-                                                    tta=True)
-
-    assert (len(support_loader) == n_episodes * support_epochs)
-    assert (len(query_loader) == n_episodes)
-
-    support_iterator = iter(support_loader)
+    if params.ft_unified_loader and params.ft_prefetch_depth > 0:
+        raise ValueError('--ft_prefetch_depth is not supported with --ft_unified_loader')
+    if params.ft_threaded_loader and params.ft_prefetch_depth > 0:
+        # Augmentations would draw from the global RNGs in the prefetch thread, concurrently with the main thread
+        raise ValueError('--ft_prefetch_depth is not supported with --ft_threaded_loader')
+    if params.ft_unified_loader:
+        episode_loader = get_unified_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s,
+                                                         n_query_shot=q, n_episodes=n_episodes,
+                                                         n_epochs=support_epochs,
+                                                         augmentation=params.ft_augmentation,
+                                                         tta_augmentation=tta_augmentation,
+                                                         n_tta_views=tta_num_samples[-1]-1,
+                                                         unlabeled_ratio=params.unlabeled_ratio,
+                                                         num_workers=params.num_workers,
+                                                         split_seed=params.split_seed,
+                                                         episode_seed=params.ft_episode_seed,
+                                                         data_store=params.ft_data_store,
+                                                         reduced_decode=params.ft_reduced_decode,
+                                                         uint8=params.ft_uint8_transport,
+                                                         image_backend=params.ft_image_backend,
+                                                         fetch_threads=params.ft_fetch_threads,
+                                                         threaded=params.ft_threaded_loader,
+                                                         single_channel=params.ft_single_channel,
+                                                         tta_multiview=params.ft_tta_multiview)
+    else:
+        support_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=True,
+                                                        n_query_shot=q, n_episodes=n_episodes, n_epochs=support_epochs,
+                                                        augmentation=support_augmentation,
+                                                        unlabeled_ratio=params.unlabeled_ratio,
+                                                        num_workers=params.num_workers,
+                                                        split_seed=params.split_seed,
+                                                        episode_seed=params.ft_episode_seed,
+                                                        data_store=params.ft_data_store,
+                                                        reduced_decode=params.ft_reduced_decode,
+                                                        uint8=params.ft_uint8_transport,
+                                                        image_backend=params.ft_image_backend,
+                                                        fetch_threads=params.ft_fetch_threads,
+                                                        threaded=params.ft_threaded_loader,
+                                                        single_channel=params.ft_single_channel)
+
+        query_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=False,
+                                                        n_query_shot=q, n_episodes=n_episodes, n_epochs=1,
+                                                        augmentation=None,
+                                                        unlabeled_ratio=params.unlabeled_ratio,
+                                                        num_workers=params.num_workers,
+                                                        split_seed=params.split_seed,
+                                                        episode_seed=params.ft_episode_seed,
+                                                        data_store=params.ft_data_store,
+                                                        reduced_decode=params.ft_reduced_decode,
+                                                        uint8=params.ft_uint8_transport,
+                                                        image_backend=params.ft_image_backend,
+                                                        fetch_threads=params.ft_fetch_threads,
+                                                        threaded=params.ft_threaded_loader,
+                                                        single_channel=params.ft_single_channel)
+        query_tta_loader = get_labeled_episodic_dataloader(params.target_dataset, n_way=w, n_shot=s, support=False,
+                                                        n_query_shot=q, n_episodes=n_episodes, n_epochs=tta_epochs, # here, n_epochs should be set to tta augmentation samples #
+                                                        augmentation=tta_augmentation,
+                                                        unlabeled_ratio=params.unlabeled_ratio,
+                                                        num_workers=params.num_workers,
+                                                        split_seed=params.split_seed,
+                                                        episode_seed=params.ft_episode_seed,
+                                                        data_store=params.ft_data_store,
+                                                        reduced_decode=params.ft_reduced_decode,
+                                                        uint8=params.ft_uint8_transport,
+                                                        image_backend=params.ft_image_backend,
+                                                        fetch_threads=params.ft_fetch_threads,
+                                                        threaded=params.ft_threaded_loader,
+                                                        single_channel=params.ft_single_channel,
+                                                        tta=True, tta_views=tta_views)
+
+        assert (len(support_loader) == n_episodes * support_epochs)
+        assert (len(query_loader) == n_episodes)
+
     support_batches = math.ceil(n_data / bs)
-    query_iterator = iter(query_loader)
-    query_tta_iterator = iter(query_tta_loader)
+    if params.ft_unified_loader:
+        episode_iterator = iter(episode_loader)
+    elif params.ft_prefetch_depth > 0:
+        # Streams in consumption order: the query batch, the support batches of all epochs, then the TTA batches
+        prefetcher = EpisodePrefetcher({'query': (query_loader, 1), 'support': (support_loader, support_epochs),
+                                        'query_tta': (query_tta_loader, tta_epochs)},
+                                       n_episodes=n_episodes, depth=params.ft_prefetch_depth)
+        episode_iterator = iter(prefetcher)
+    else:
+        support_iterator = iter(support_loader)
+        query_iterator = iter(query_loader)
+        query_tta_iterator = iter(query_tta_loader)
 
     # Output (history, params)
     train_history_path = get_ft_train_history_path(output_dir)
@@ -208,6 +278,17 @@ def main(params):
 
     # For each episode
     for episode in range(n_episodes):
+        if params.ft_unified_loader:
+            episode_views = next(episode_iterator)
+            support_iterator = episode_views.support_views()
+            query_iterator = iter([episode_views.query])
+            query_tta_iterator = episode_views.query_tta_views()
+        elif params.ft_prefetch_depth > 0:
+            episode_batches = next(episode_iterator)
+            support_iterator = iter(episode_batches['support'])
+            query_iterator = iter(episode_batches['query'])
+            query_tta_iterator = iter(episode_batches['query_tta'])
+
         # Reset models for each episode
         if not torch_pretrained:
             body.load_state_dict(copy.deepcopy(state))  # note, override model.load_state_dict to change this behavior.
@@ -239,12 +320,15 @@ def main(params):
         y_support = torch.arange(w).repeat_interleave(s).cuda() 
         y_support_np = y_support.cpu().numpy()
 
-        x_query = next(query_iterator)[0].cuda()
+        x_query = normalize_uint8(next(query_iterator)[0].cuda())
         y_query = torch.arange(w).repeat_interleave(q).cuda() 
         f_query = None
         y_query_np = y_query.cpu().numpy()
         x_query_tta = None
 
+        if batch_transform is not None:
+            x_support_raw = normalize_uint8(next(support_iterator)[0].cuda(), normalize=False)
+
         train_acc_history = []
         train_loss_history = []
         test_acc_history = []
@@ -262,7 +346,10 @@ def main(params):
             if params.ft_scheduler_end is not None: # if augmentation is scheduled
                 aug_bool = (epoch < params.ft_scheduler_end and epoch >= params.ft_scheduler_start) and aug_bool
 
-            x_support = next(support_iterator)[0].cuda()
+            if batch_transform is not None:
+                x_support = batch_transform(x_support_raw)
+            else:
+                x_support = normalize_uint8(next(support_iterator)[0].cuda())
 
             total_loss = 0
             correct = 0
@@ -356,8 +443,13 @@ def main(params):
                     query_list = pred.unsqueeze(0)
 
                     # TTA Evaluation
-                    for _ in range(tta_num_samples[-1]-1):
-                        x_query_tta = next(query_tta_iterator)[0].cuda()
+                    if params.ft_tta_multiview:
+                        # [w * q, K, C, H, W], i.e., all K views of each query image from a single fetch
+                        x_query_tta_views = normalize_uint8(next(query_tta_iterator)[0].cuda()).unbind(dim=1)
+                    else:
+                        x_query_tta_views = (normalize_uint8(next(query_tta_iterator)[0].cuda())
+                                             for _ in range(tta_num_samples[-1]-1))
+                    for x_query_tta in x_query_tta_views:
                         f_query_tta = body_forward(x_query_tta, body, backbone, torch_pretrained, params)
                         pred_tta = head(f_query_tta)
                         query_list = torch.cat([query_list, pred_tta.unsqueeze(0)], dim=0)
@@ -0,0 +1,183 @@
+"""
+Ensemble fine-tuning: trains the body and head of several episodes in lockstep.
+
+A single 5-way 1-shot or 5-shot episode is far too small to occupy the GPU, so episodes are fine-tuned in groups of E
+instead. The parameters and buffers (e.g., BN running statistics) of the E body+head copies are stacked into tensors
+of shape [E, ...] (`torch.func.stack_module_state`), and a single forward pass over a stacked batch [E, B, C, H, W]
+computes the predictions of all copies (`torch.func.functional_call` under `torch.func.vmap`). The episodes are
+independent, so the gradients of the summed loss are the per-episode gradients, and `torch.optim.SGD` on the stacked
+tensors performs the per-episode updates (momentum buffers are stacked as well). Gradient clipping is per episode.
+
+Each episode keeps its own support and query data, mini-batch permutations and MixUp/CutMix parameters
+(`finetuning.mix.EpochPlan`). The episode preparation (model reset, head initialization, initial query forward) and
+the plans of all epochs are done sequentially, episode by episode, so that the RNGs are consumed in the same order as
+by sequential fine-tuning. Results thus match sequential execution up to floating-point differences.
+
+Implementation note: the random draws inside the models (e.g., dropout) differ from sequential execution (vmap draws
+different randomness for each copy), and random image augmentations differ if they draw from the main process RNG
+(threaded loader). Per-episode V-measure scores are not supported.
+"""
+
+import copy
+import math
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.func import functional_call, stack_module_state, vmap
+
+from finetuning.mix import EpochPlan, apply_mix
+from finetuning.optim import batched_clip_grad_norm_
+from utils import body_forward
+
+
+class EpisodeModel(nn.Module):
+    """
+    Body and head of a single episode, as a single module (the unit that is stacked over episodes).
+    """
+
+    def __init__(self, body: nn.Module, head: nn.Module, torch_pretrained: bool, params):
+        super().__init__()
+        self.body = body
+        self.head = head
+        self.torch_pretrained = torch_pretrained
+        self.params = params
+
+    def forward(self, x):
+        return self.head(body_forward(x, self.body, None, self.torch_pretrained, self.params))
+
+
+class EnsembleFinetuner:
+    """
+    Fine-tunes the episodes added with `add_episode` in lockstep (see module docstring), with the same settings as
+    the fine-tuning loop in `finetune.py`: torch.optim.SGD with the given hyperparameters on head and body, and query
+    evaluation every 50 epochs and after the last epoch.
+    """
+
+    def __init__(self, params, torch_pretrained: bool, n_epochs: int, batch_size: int, lr: float, momentum=0.9,
+                 dampening=0.9, weight_decay=0.001, clip_grad_norm: float = None):
+        """
+        :param clip_grad_norm: Max norm of the body and head gradients of each episode (e.g., 1 for ViT backbones)
+        """
+        self.params = params
+        self.torch_pretrained = torch_pretrained
+        self.n_epochs = n_epochs
+        self.batch_size = batch_size
+        self.lr = lr
+        self.momentum = momentum
+        self.dampening = dampening
+        self.weight_decay = weight_decay
+        self.clip_grad_norm = clip_grad_norm
+        self.episodes = []
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def add_episode(self, body: nn.Module, head: nn.Module, x_query: torch.Tensor, y_support: torch.Tensor,
+                    y_query: torch.Tensor, plans: List[EpochPlan]):
+        """
+        :param body: Body of the episode, after reset (copied, so the caller may reset it for the next episode)
+        :param head: Freshly initialized head of the episode
+        :param plans: Plan of each epoch (see `finetuning.mix.draw_epoch_plan`)
+        """
+        if len(plans) != self.n_epochs:
+            raise ValueError('Invalid number of epoch plans: {}'.format(len(plans)))
+        model = EpisodeModel(copy.deepcopy(body), copy.deepcopy(head), self.torch_pretrained, self.params)
+        self.episodes.append((model, x_query, y_support, y_query, plans))
+
+    def _set_train_mode(self, model: EpisodeModel):
+        model.train()
+        if self.params.ft_parts == 'head' or self.params.ft_parts == 'bn_full':
+            model.body.eval()
+
+    def _is_test_epoch(self, epoch: int) -> bool:
+        return (epoch + 1) % 50 == 0 or epoch == self.n_epochs - 1
+
+    def run(self, support_batches: Iterable[torch.Tensor]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Fine-tunes all added episodes, and clears them.
+
+        :param support_batches: Support images of all episodes for each epoch, as [E, n_data, C, H, W] (in the order
+                                of `add_episode`)
+        :return: train_acc_history, train_loss_history, test_acc_history, each of shape [E, n_epochs]
+        """
+        models, x_query, y_support, y_query, plans = zip(*self.episodes)
+        self.episodes = []
+        n_episodes = len(models)
+        x_query = torch.stack(x_query)
+        y_support = torch.stack(y_support)
+        y_query = torch.stack(y_query)
+        n_data = y_support.shape[1]
+        n_batches = math.ceil(n_data / self.batch_size)
+
+        weights, buffers = stack_module_state(list(models))
+        # Stateless copy of the module structure, for functional_call
+        base = copy.deepcopy(models[0]).to('meta')
+        del models
+
+        def compute(p, b, x):
+            return functional_call(base, (p, b), (x,))
+
+        forward = vmap(compute, randomness='different')
+        optimizer = torch.optim.SGD([
+            {'params': [p for name, p in weights.items() if name.startswith('head.')]},
+            {'params': [p for name, p in weights.items() if not name.startswith('head.')]},
+        ], lr=self.lr, momentum=self.momentum, dampening=self.dampening, weight_decay=self.weight_decay)
+
+        episode_range = torch.arange(n_episodes, device=y_support.device).unsqueeze(1)
+        history = np.zeros((3, n_episodes, self.n_epochs))
+        for epoch, x_support in zip(range(self.n_epochs), support_batches):
+            self._set_train_mode(base)
+            epoch_plans = [episode_plans[epoch] for episode_plans in plans]
+
+            # Mix each episode with its own plan; without mixing, y_shuffled = y_support and lam = 1
+            x_support_aug = []
+            y_shuffled = []
+            for plan, x, y in zip(epoch_plans, x_support, y_support):
+                x_aug, y_shuf = apply_mix(plan, x, y)
+                x_support_aug.append(x_aug)
+                y_shuffled.append(y if y_shuf is None else y_shuf)
+            x_support_aug = torch.stack(x_support_aug)
+            y_shuffled = torch.stack(y_shuffled)
+            lam = torch.tensor([1. if plan.lam is None else plan.lam for plan in epoch_plans],
+                               device=y_support.device)
+            indices = torch.from_numpy(np.stack([plan.indices for plan in epoch_plans])).to(y_support.device)
+
+            total_loss = 0
+            correct = 0
+            for i in range(n_batches):
+                batch_indices = indices[:, i * self.batch_size:min(i * self.batch_size + self.batch_size, n_data)]
+                y_batch = y_support[episode_range, batch_indices]
+                y_shuffled_batch = y_shuffled[episode_range, batch_indices]
+
+                pred = forward(weights, buffers, x_support_aug[episode_range, batch_indices])
+                correct += torch.eq(y_batch, pred.argmax(dim=2)).sum(dim=1)
+
+                # Mean cross entropy of each episode, as criterion(pred, y_batch) on each episode
+                loss = F.cross_entropy(pred.flatten(0, 1), y_batch.flatten(), reduction='none').view(y_batch.shape)
+                loss_shuffled = F.cross_entropy(pred.flatten(0, 1), y_shuffled_batch.flatten(),
+                                                reduction='none').view(y_batch.shape)
+                loss = loss.mean(dim=1) * lam + loss_shuffled.mean(dim=1) * (1. - lam)
+
+                optimizer.zero_grad()
+                loss.sum().backward()
+                if self.clip_grad_norm is not None:
+                    with torch.no_grad():
+                        batched_clip_grad_norm_([p.grad for p in weights.values() if p.grad is not None],
+                                                self.clip_grad_norm)
+                optimizer.step()
+
+                total_loss += loss.detach()
+
+            history[0, :, epoch] = (correct / n_data).cpu().numpy()
+            history[1, :, epoch] = (total_loss / n_batches).cpu().numpy()
+
+            if self._is_test_epoch(epoch):
+                base.eval()
+                with torch.no_grad():
+                    pred = forward(weights, buffers, x_query)
+                    correct = torch.eq(y_query, pred.argmax(dim=2)).sum(dim=1)
+                history[2, :, epoch] = (correct / y_query.shape[1]).cpu().numpy()
+        return history[0], history[1], history[2]
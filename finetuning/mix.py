@@ -0,0 +1,115 @@
+"""
+Per-epoch random choices of fine-tuning: the mini-batch permutation of the support set and the MixUp/CutMix parameters.
+
+The choices of an epoch are drawn up front as an `EpochPlan` (`draw_epoch_plan`), from the global numpy/torch RNGs and
+in the same order as the original loop in `finetune.py`, and are then applied to the support images (`apply_mix`).
+Since the draws do not depend on the images, the plans of all epochs of an episode can also be drawn before training,
+e.g., to train several episodes in lockstep (see `finetuning.ensemble`) with the same random choices as sequential
+execution. With `PlanBuffers`, the permutations are drawn into preallocated arrays instead (see `finetuning.workspace`).
+"""
+
+from collections import namedtuple
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+
+from datasets.transforms import rand_bbox
+
+EpochPlan = namedtuple('EpochPlan', ['indices', 'aug', 'lam', 'indices_shuffled', 'bbox'])
+EpochPlan.__doc__ = """
+indices: permutation of the support set (mini-batches are consecutive slices), aug: whether augmentation is active in
+this epoch, lam: mixing coefficient (None without MixUp/CutMix), indices_shuffled: mixing partner of each sample,
+bbox: CutMix box (bbx1, bby1, bbx2, bby2)
+"""
+
+
+class PlanBuffers:
+    """
+    Preallocated index arrays for `draw_epoch_plan`. Permutations are drawn by shuffling these arrays in place, which
+    consumes the same random numbers as `np.random.permutation` (and `torch.randperm`), i.e., yields the same plans.
+    The arrays are overwritten by the next draw.
+    """
+
+    def __init__(self, n_data: int):
+        self.arange = np.arange(n_data)
+        self.indices = np.arange(n_data)
+        self.indices_shuffled = np.arange(n_data)
+        # Tensor views of the arrays (sharing memory)
+        self.indices_tensor = torch.from_numpy(self.indices)
+        self.indices_shuffled_tensor = torch.from_numpy(self.indices_shuffled)
+
+
+def is_augmented_epoch(params, epoch: int) -> bool:
+    aug_bool = bool(params.ft_mixup or params.ft_cutmix or params.ft_augmentation)
+    if params.ft_scheduler_end is not None:  # if augmentation is scheduled
+        aug_bool = (epoch < params.ft_scheduler_end and epoch >= params.ft_scheduler_start) and aug_bool
+    return aug_bool
+
+
+def draw_epoch_plan(params, epoch: int, n_way: int, n_shot: int, image_shape, class_shuffled=None,
+                    buffers: PlanBuffers = None) -> EpochPlan:
+    """
+    :param image_shape: Shape of the support batch [N, C, H, W] (for CutMix boxes)
+    :param class_shuffled: Class permutations without fixed points (for MixUp/CutMix 'between')
+    :param buffers: Draw the permutations into these arrays, instead of new ones
+    """
+    n_data = n_way * n_shot
+    aug_bool = is_augmented_epoch(params, epoch)
+    if buffers is None:
+        indices = np.random.permutation(n_data)
+    else:
+        indices = buffers.indices
+        np.copyto(indices, buffers.arange)
+        np.random.shuffle(indices)
+    if not (aug_bool and (params.ft_mixup or params.ft_cutmix)):
+        return EpochPlan(indices, aug_bool, None, None, None)
+
+    mode = params.ft_mixup or params.ft_cutmix
+    lam = np.random.beta(1.0, 1.0)
+    if mode == 'both':
+        if buffers is None:
+            indices_shuffled = torch.randperm(n_data)
+        else:
+            indices_shuffled = torch.randperm(n_data, out=buffers.indices_shuffled_tensor)
+    else:
+        if mode == 'within':
+            class_arr = range(n_way)
+        elif mode == 'between':
+            class_arr_idx = np.random.choice(range(len(class_shuffled)), 1)[0]
+            class_arr = class_shuffled[class_arr_idx]
+        else:
+            raise ValueError('Unknown mode: {}'.format(mode))
+        if buffers is None:
+            shuffled = [np.random.permutation(range(clss * n_shot, (clss + 1) * n_shot)) for clss in class_arr]
+            indices_shuffled = torch.from_numpy(np.concatenate(shuffled)).long()
+        else:
+            for k, clss in enumerate(class_arr):
+                block = buffers.indices_shuffled[k * n_shot:(k + 1) * n_shot]
+                np.copyto(block, buffers.arange[clss * n_shot:(clss + 1) * n_shot])
+                np.random.shuffle(block)
+            indices_shuffled = buffers.indices_shuffled_tensor
+
+    bbox = None
+    if not params.ft_mixup:
+        bbox = rand_bbox(image_shape, lam)
+        bbx1, bby1, bbx2, bby2 = bbox
+        lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (image_shape[-1] * image_shape[-2]))  # adjust lambda
+    return EpochPlan(indices, aug_bool, lam, indices_shuffled, bbox)
+
+
+def apply_mix(plan: EpochPlan, x_support: torch.Tensor, y_support: torch.Tensor) \
+        -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    :return: x_support_aug: mixed support images (x_support itself without MixUp/CutMix), y_shuffled: labels of the
+             mixing partners (None without MixUp/CutMix)
+    """
+    if plan.lam is None:
+        return x_support, None
+    if plan.bbox is None:  # mixup
+        x_support_aug = plan.lam * x_support + (1. - plan.lam) * x_support[plan.indices_shuffled]
+    else:  # cutmix
+        bbx1, bby1, bbx2, bby2 = plan.bbox
+        x_support_aug = x_support.clone()
+        x_support_aug[:, :, bbx1:bbx2, bby1:bby2] = x_support[plan.indices_shuffled, :, bbx1:bbx2, bby1:bby2]
+    return x_support_aug, y_support[plan.indices_shuffled]
@@ -0,0 +1,24 @@
+"""
+Optimization helpers for parameters stacked over episodes, i.e., tensors of shape [E, ...] that hold the parameters
+of E independent models (see `finetuning.probe.BatchedProbe` and `finetuning.ensemble`).
+"""
+
+from typing import Iterable
+
+import torch
+
+
+def batched_clip_grad_norm_(grads: Iterable[torch.Tensor], max_norm: float) -> torch.Tensor:
+    """
+    In-place equivalent of `torch.nn.utils.clip_grad_norm_` on each episode, i.e., the gradients of each episode are
+    scaled by the total norm of that episode only.
+
+    :param grads: Gradients stacked over episodes, each of shape [E, ...]
+    :return: [E], total gradient norm of each episode (before clipping)
+    """
+    grads = list(grads)
+    norm = torch.sqrt(sum(g.flatten(1).pow(2).sum(dim=1) for g in grads))
+    clip_coef = torch.clamp(max_norm / (norm + 1e-6), max=1.0)
+    for g in grads:
+        g.mul_(clip_coef.view(-1, *[1] * (g.dim() - 1)))
+    return norm
@@ -0,0 +1,263 @@
+"""
+Linear probing on cached features.
+
+With a frozen body (`--ft_parts head`, i.e., in eval mode) and without image augmentation or mixing, the features of
+the support and query images are the same in every epoch. They are thus computed once per episode (`encode`), and the
+head is trained on the cached feature tensors only (`train_probe`), with the same mini-batches, optimizer steps and
+random permutations as the image-based loop in `finetune.py`. Evaluating on the query set is a single head forward,
+so the query accuracy can be recorded after every epoch at no cost.
+
+With a batched probe solver (`BatchedProbe`), the heads of all episodes are trained at once instead, after the
+features of all episodes have been cached.
+
+Implementation note: the body sees the whole support set at once rather than mini-batches of `ft_batch_size` images.
+In eval mode, this only affects floating-point rounding (e.g., by the choice of convolution algorithm).
+"""
+
+import math
+from typing import List, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from finetuning.optim import batched_clip_grad_norm_
+from utils import body_forward
+
+
+def can_cache_features(params) -> bool:
+    """
+    Whether support and query features are fixed during fine-tuning, i.e., whether `train_probe` applies. Not with
+    V-measure scores (which are recorded per test epoch of the image-based loop), nor with batch augmentation (which
+    loads raw, un-normalized support images).
+    """
+    no_augmentation = params.ft_augmentation is None or params.ft_augmentation.lower() == 'none'
+    return (params.ft_parts == 'head' and no_augmentation and not (params.ft_mixup or params.ft_cutmix) and
+            not params.v_score and not params.ft_batch_augmentation)
+
+
+def encode(x: torch.Tensor, body, backbone, torch_pretrained: bool, params) -> torch.Tensor:
+    """
+    Features of a batch of images, computed with the body in eval mode.
+    """
+    body.eval()
+    with torch.no_grad():
+        return body_forward(x, body, backbone, torch_pretrained, params)
+
+
+def train_probe(head: nn.Module, optimizer: torch.optim.Optimizer, criterion, f_support: torch.Tensor,
+                y_support: torch.Tensor, f_query: torch.Tensor, y_query: torch.Tensor, n_epochs: int,
+                batch_size: int, intermediate_test=False, clip_grad_norm: float = None) \
+        -> Tuple[List[float], List[float], List[float]]:
+    """
+    Trains the head on cached support features, as the fine-tuning loop in `finetune.py` does on support images.
+
+    :param intermediate_test: Evaluate on the query set after every epoch. Otherwise, only every 50 epochs and after the
+                              last epoch (test accuracy is 0 for other epochs), as in `finetune.py`.
+    :param clip_grad_norm: Max norm of the head gradients (e.g., 1 for ViT backbones), if given
+    :return: train_acc_history, train_loss_history, test_acc_history
+    """
+    n_data = len(f_support)
+    n_batches = math.ceil(n_data / batch_size)
+
+    train_acc_history = []
+    train_loss_history = []
+    test_acc_history = []
+    for epoch in range(n_epochs):
+        head.train()
+        total_loss = 0
+        correct = 0
+        indices = np.random.permutation(n_data)
+
+        for i in range(n_batches):
+            batch_indices = indices[i * batch_size:min(i * batch_size + batch_size, n_data)]
+            y_batch = y_support[batch_indices]
+            pred = head(f_support[batch_indices])
+            correct += torch.eq(y_batch, pred.argmax(dim=1)).sum()
+            loss = criterion(pred, y_batch)
+
+            optimizer.zero_grad()
+            loss.backward()
+            if clip_grad_norm is not None:
+                torch.nn.utils.clip_grad_norm_(head.parameters(), max_norm=clip_grad_norm)
+            optimizer.step()
+
+            total_loss += loss.item()
+
+        if intermediate_test or (epoch + 1) % 50 == 0 or epoch == n_epochs - 1:
+            head.eval()
+            with torch.no_grad():
+                pred = head(f_query)
+                test_acc = torch.eq(y_query, pred.argmax(dim=1)).sum() / pred.shape[0]
+        else:
+            test_acc = torch.tensor(0)
+
+        train_acc_history.append((correct / n_data).item())
+        train_loss_history.append(total_loss / n_batches)
+        test_acc_history.append(test_acc.item())
+    return train_acc_history, train_loss_history, test_acc_history
+
+
+PROBE_SOLVERS = ['sgd', 'lbfgs', 'ridge']
+
+
+def _batched_logits(f: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor) -> torch.Tensor:
+    """
+    :param f: [E, N, D], weight: [E, C, D], bias: [E, C]
+    :return: [E, N, C]
+    """
+    return torch.baddbmm(bias.unsqueeze(1), f, weight.transpose(1, 2))
+
+
+def _batched_loss(logits: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    """
+    :return: [E], mean cross entropy of each episode
+    """
+    return F.cross_entropy(logits.flatten(0, 1), y.flatten(), reduction='none').view(y.shape).mean(dim=1)
+
+
+def _batched_correct(logits: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    return torch.eq(y, logits.argmax(dim=2)).sum(dim=1)
+
+
+class BatchedProbe:
+    """
+    Trains the linear heads of all episodes at once, as a single [E, n_way, feat_dim] weight tensor, on cached features
+    (see `train_probe`). Episodes are added in order, with their initial head, so that head initializations and
+    mini-batch permutations are drawn from the RNGs in the same order as with `train_probe`.
+
+    Solvers:
+    - `sgd`: the optimization of `train_probe` (torch.optim.SGD with the given settings, mini-batches of batch_size
+      with per-episode permutations, and gradient clipping), vectorized over episodes.
+    - `lbfgs`: full-batch L-BFGS on the mean cross entropy plus L2 regularization (weight_decay / 2), one iteration
+      per epoch. Each episode has its own optimizer (line search and curvature history), so episodes are solved one
+      after the other.
+    - `ridge`: closed-form regularized least squares on one-hot targets (with N * weight_decay as the ridge
+      coefficient), solved in the dual since there are fewer support samples than features. Only the last epoch is
+      recorded, with the cross entropy of the ridge logits as loss.
+    """
+
+    def __init__(self, solver: str, n_epochs: int, batch_size: int, lr: float, momentum=0.9, dampening=0.9,
+                 weight_decay=0.001, intermediate_test=False, clip_grad_norm: float = None):
+        if solver not in PROBE_SOLVERS:
+            raise ValueError('Unsupported probe solver: {}'.format(solver))
+        self.solver = solver
+        self.n_epochs = n_epochs
+        self.batch_size = batch_size
+        self.lr = lr
+        self.momentum = momentum
+        self.dampening = dampening
+        self.weight_decay = weight_decay
+        self.intermediate_test = intermediate_test
+        self.clip_grad_norm = clip_grad_norm
+        self.episodes = []
+
+    def add_episode(self, head: nn.Module, f_support: torch.Tensor, y_support: torch.Tensor, f_query: torch.Tensor,
+                    y_query: torch.Tensor):
+        """
+        :param head: Freshly initialized `LinearClassifier` of the episode
+        """
+        permutations = np.stack([np.random.permutation(len(f_support)) for _ in range(self.n_epochs)])
+        # Copies, since the head may be re-initialized in place for the next episode (see `finetuning.reset`)
+        self.episodes.append((head.fc.weight.detach().clone(), head.fc.bias.detach().clone(), f_support, y_support,
+                              f_query, y_query, permutations))
+
+    def _is_test_epoch(self, epoch: int) -> bool:
+        return self.intermediate_test or (epoch + 1) % 50 == 0 or epoch == self.n_epochs - 1
+
+    def run(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: train_acc_history, train_loss_history, test_acc_history, each of shape [E, n_epochs]
+        """
+        weight, bias, f_support, y_support, f_query, y_query, permutations = \
+            [torch.stack([torch.as_tensor(x) for x in xs]) for xs in zip(*self.episodes)]
+        history = np.zeros((3, len(weight), self.n_epochs))
+        solve = {'sgd': self._run_sgd, 'lbfgs': self._run_lbfgs, 'ridge': self._run_ridge}[self.solver]
+        solve(weight, bias, f_support, y_support, f_query, y_query, permutations.to(f_support.device), history)
+        return history[0], history[1], history[2]
+
+    def _test(self, weight, bias, f_query, y_query, history, epoch):
+        if self._is_test_epoch(epoch):
+            with torch.no_grad():
+                correct = _batched_correct(_batched_logits(f_query, weight, bias), y_query)
+            history[2, :, epoch] = (correct / y_query.shape[1]).cpu().numpy()
+
+    def _run_sgd(self, weight, bias, f_support, y_support, f_query, y_query, permutations, history):
+        n_data = f_support.shape[1]
+        n_batches = math.ceil(n_data / self.batch_size)
+        params = [weight.requires_grad_(), bias.requires_grad_()]
+        buffers = [None, None]
+        for epoch in range(self.n_epochs):
+            total_loss = 0
+            correct = 0
+            for i in range(n_batches):
+                batch_indices = permutations[:, epoch, i * self.batch_size:min(i * self.batch_size + self.batch_size,
+                                                                               n_data)]
+                f_batch = torch.gather(f_support, 1, batch_indices.unsqueeze(-1).expand(-1, -1, f_support.shape[2]))
+                y_batch = torch.gather(y_support, 1, batch_indices)
+                logits = _batched_logits(f_batch, weight, bias)
+                correct += _batched_correct(logits, y_batch)
+                loss = _batched_loss(logits, y_batch)
+                grads = torch.autograd.grad(loss.sum(), params)
+
+                with torch.no_grad():
+                    if self.clip_grad_norm is not None:
+                        # Per episode, as clip_grad_norm_ on each head
+                        batched_clip_grad_norm_(grads, self.clip_grad_norm)
+                    # Same update as torch.optim.SGD (without nesterov)
+                    for j, (p, g) in enumerate(zip(params, grads)):
+                        g = g.add(p, alpha=self.weight_decay)
+                        if buffers[j] is None:
+                            buffers[j] = g.clone()
+                        else:
+                            buffers[j].mul_(self.momentum).add_(g, alpha=1 - self.dampening)
+                        p.add_(buffers[j], alpha=-self.lr)
+                total_loss += loss.detach()
+
+            history[0, :, epoch] = (correct / n_data).cpu().numpy()
+            history[1, :, epoch] = (total_loss / n_batches).cpu().numpy()
+            self._test(weight, bias, f_query, y_query, history, epoch)
+
+    def _run_lbfgs(self, weight, bias, f_support, y_support, f_query, y_query, permutations, history):
+        for e in range(len(weight)):
+            # Single-episode batches [1, ...], and the view of the history of this episode
+            self._run_lbfgs_episode(weight[e:e + 1].clone(), bias[e:e + 1].clone(), f_support[e:e + 1],
+                                    y_support[e:e + 1], f_query[e:e + 1], y_query[e:e + 1], history[:, e:e + 1])
+
+    def _run_lbfgs_episode(self, weight, bias, f_support, y_support, f_query, y_query, history):
+        params = [weight.requires_grad_(), bias.requires_grad_()]
+        optimizer = torch.optim.LBFGS(params, lr=1, max_iter=1, line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            loss = _batched_loss(_batched_logits(f_support, weight, bias), y_support).sum()
+            loss = loss + self.weight_decay / 2 * (weight.pow(2).sum() + bias.pow(2).sum())
+            loss.backward()
+            return loss
+
+        for epoch in range(self.n_epochs):
+            optimizer.step(closure)
+            with torch.no_grad():
+                logits = _batched_logits(f_support, weight, bias)
+                history[0, :, epoch] = (_batched_correct(logits, y_support) / f_support.shape[1]).cpu().numpy()
+                history[1, :, epoch] = _batched_loss(logits, y_support).cpu().numpy()
+            self._test(weight, bias, f_query, y_query, history, epoch)
+
+    def _run_ridge(self, weight, bias, f_support, y_support, f_query, y_query, permutations, history):
+        n_data = f_support.shape[1]
+        n_classes = weight.shape[1]
+        # Bias as an extra (regularized) feature, as weight decay applies to the bias in SGD as well
+        x = F.pad(f_support, (0, 1), value=1.0)
+        y = F.one_hot(y_support, n_classes).to(x.dtype)
+        gram = torch.bmm(x, x.transpose(1, 2))
+        gram.diagonal(dim1=1, dim2=2).add_(n_data * self.weight_decay)
+        # [E, C, D + 1] = (X^T (X X^T + lambda I)^-1 Y)^T
+        solution = torch.bmm(x.transpose(1, 2), torch.linalg.solve(gram, y)).transpose(1, 2)
+        weight, bias = solution[:, :, :-1], solution[:, :, -1]
+
+        last = self.n_epochs - 1
+        logits = _batched_logits(f_support, weight, bias)
+        history[0, :, last] = (_batched_correct(logits, y_support) / n_data).cpu().numpy()
+        history[1, :, last] = _batched_loss(logits, y_support).cpu().numpy()
+        self._test(weight, bias, f_query, y_query, history, last)
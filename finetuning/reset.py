@@ -0,0 +1,163 @@
+"""
+Fast per-episode reset of the fine-tuned models.
+
+Fine-tuning starts every episode from the pretrained body, a freshly initialized head and an empty optimizer state.
+Instead of reloading a (deep-copied) state dict or deep-copying the pretrained backbone for every episode, which
+allocates and copies every tensor anew:
+- `ModelSnapshot` captures the parameters and buffers of the pretrained body once, as one flat contiguous buffer per
+  dtype (in pinned host memory or on the device), and restores them in place with multi-tensor copies.
+- `ModuleInitializer` re-initializes the head in place, with the same random draws as constructing a new head. It also
+  replays the random draws of the model wrapper of torch pretrained backbones, which is built once per run.
+- `ResettableSGD` resets its state for a new episode, and re-initializes the existing momentum buffers in place.
+
+The model tensors (and the momentum buffers) are thus allocated once per run rather than once per episode.
+"""
+
+import copy
+from typing import Iterable, List
+
+import torch
+from torch import nn
+
+
+def _module_tensors(module: nn.Module) -> List[torch.Tensor]:
+    return list(module.parameters()) + list(module.buffers())
+
+
+def _copy_(targets: List[torch.Tensor], sources: List[torch.Tensor], non_blocking=False):
+    with torch.no_grad():
+        if hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(targets, sources, non_blocking=non_blocking)
+        else:
+            for target, source in zip(targets, sources):
+                target.copy_(source, non_blocking=non_blocking)
+
+
+class ModelSnapshot:
+    """
+    Copy of the parameters and buffers of a module, restored into the same tensors in place (`restore`). The module
+    must keep its tensors, i.e., be trained in place (as by optimizers) rather than have its tensors replaced.
+    """
+
+    def __init__(self, module: nn.Module, device=None, modes=False):
+        """
+        :param device: Device of the snapshot. By default, pinned host memory for CUDA modules (restored with
+                       asynchronous copies), or the device of the module otherwise.
+        :param modes: Restore the train/eval mode of all submodules as well
+        """
+        self.module = module
+        self.targets = _module_tensors(module)
+        self.modes = [(m, m.training) for m in module.modules()] if modes else []
+
+        pin_memory = device is None and any(t.is_cuda for t in self.targets)
+        if pin_memory:
+            device = 'cpu'
+        self.non_blocking = pin_memory
+
+        # One flat buffer per dtype, and a view of it for each tensor
+        self.buffers = {}
+        self.sources = [None] * len(self.targets)
+        for dtype in {t.dtype for t in self.targets}:
+            positions = [i for i, t in enumerate(self.targets) if t.dtype == dtype]
+            with torch.no_grad():
+                flat = torch.cat([self.targets[i].detach().reshape(-1).to(device or self.targets[i].device)
+                                  for i in positions])
+            if pin_memory:
+                flat = flat.pin_memory()
+            self.buffers[dtype] = flat
+            for i, view in zip(positions, flat.split([self.targets[i].numel() for i in positions])):
+                self.sources[i] = view.view(self.targets[i].shape)
+
+    def nbytes(self) -> int:
+        return sum(flat.numel() * flat.element_size() for flat in self.buffers.values())
+
+    def restore(self):
+        _copy_(self.targets, self.sources, non_blocking=self.non_blocking)
+        for m, training in self.modes:
+            m.training = training
+
+
+class ModuleInitializer:
+    """
+    Re-initializes a module in place (`reset`), with the same random draws as constructing it anew (on the CPU, as in
+    `finetune.py`), i.e., by calling `reset_parameters()` of its submodules in construction order on a CPU copy.
+    Only applies to modules that are fully initialized by `reset_parameters()`, e.g., the classifier heads of
+    `model.classifier_head`.
+    """
+
+    def __init__(self, module: nn.Module, exclude: nn.Module = None):
+        """
+        :param exclude: Submodule that is neither copied nor re-initialized, e.g., the pretrained backbone of a model
+                        wrapper (whose tensors are restored by a `ModelSnapshot` instead)
+        """
+        self.module = module
+        memo = {id(exclude): None} if exclude is not None else {}
+        self.template = copy.deepcopy(module, memo).cpu()
+        excluded = {id(t) for t in _module_tensors(exclude)} if exclude is not None else set()
+        self.targets = [t for t in _module_tensors(module) if id(t) not in excluded]
+        self.sources = _module_tensors(self.template)
+
+    def reset(self):
+        for m in self.template.modules():
+            if hasattr(m, 'reset_parameters'):
+                m.reset_parameters()
+        _copy_(self.targets, self.sources)
+
+
+class ResettableSGD(torch.optim.SGD):
+    """
+    `torch.optim.SGD` (without nesterov momentum) that can be reset for a new episode (`reset`) without reallocating
+    its momentum buffers: the first step after a reset overwrites the existing buffers in place, with the same update
+    as the first step of a new `torch.optim.SGD`.
+    """
+
+    def __init__(self, params, *args, **kwargs):
+        super().__init__(params, *args, **kwargs)
+        if any(group['nesterov'] or group.get('maximize', False) for group in self.param_groups):
+            raise ValueError('Unsupported SGD options for ResettableSGD: nesterov, maximize')
+        self._fresh = True
+
+    def reset(self, params: List[Iterable[torch.Tensor]] = None):
+        """
+        :param params: New parameters of each param group, if any (e.g., a rebuilt module). The state of parameters
+                       that are no longer optimized is dropped.
+        """
+        if params is not None:
+            if len(params) != len(self.param_groups):
+                raise ValueError('Invalid number of param groups: {}'.format(len(params)))
+            for group, group_params in zip(self.param_groups, params):
+                group['params'] = list(group_params)
+            current = {p for group in self.param_groups for p in group['params']}
+            for p in [p for p in self.state if p not in current]:
+                del self.state[p]
+        self._fresh = True
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        if not self._fresh:
+            return super().step(closure)
+
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    self.state.pop(p, None)  # no stale momentum from the previous episode
+                    continue
+                if group['momentum'] == 0:
+                    d_p = p.grad.add(p, alpha=group['weight_decay']) if group['weight_decay'] != 0 else p.grad
+                    p.add_(d_p, alpha=-group['lr'])
+                    continue
+                state = self.state[p]
+                buf = state.get('momentum_buffer')
+                if buf is None:
+                    buf = state['momentum_buffer'] = torch.clone(p.grad).detach()
+                else:
+                    buf.copy_(p.grad)
+                if group['weight_decay'] != 0:
+                    buf.add_(p, alpha=group['weight_decay'])
+                p.add_(buf, alpha=-group['lr'])
+        self._fresh = False
+        return loss
@@ -0,0 +1,128 @@
+"""
+Preallocated tensors of the per-episode fine-tuning loop.
+
+In small-shot settings, the epochs of `finetune.py` are short, so allocating new support, augmented, index and label
+tensors (and host-device round trips for each of them) in every epoch is a large share of the CPU time. An
+`EpisodeWorkspace` owns reusable buffers for all of them, which are allocated once (on first use) and overwritten by
+every episode and epoch:
+- support and query images, copied into device buffers and normalized in place (`normalize_uint8(out=...)`),
+- the labels of support and query sets (identical for all episodes),
+- the mini-batch and mixing permutations, drawn in place (`finetuning.mix.PlanBuffers`),
+- the MixUp/CutMix images and labels, and the mini-batches.
+
+All operations give the same values as the allocating versions (e.g., `finetuning.mix.apply_mix`). Note that returned
+tensors are views of the buffers, i.e., they are overwritten by the next call (copy them to keep them, e.g.,
+`x_query.clone()`).
+"""
+
+from typing import Optional, Tuple
+
+import torch
+
+from datasets.transforms import normalize_uint8
+from finetuning.mix import EpochPlan, PlanBuffers, draw_epoch_plan
+
+
+class EpisodeWorkspace:
+    """
+    Reusable buffers for episodes of `n_way` x `n_shot` support and `n_way` x `n_query_shot` query images, fine-tuned
+    with mini-batches of `batch_size` (see module docstring).
+    """
+
+    def __init__(self, n_way: int, n_shot: int, n_query_shot: int, batch_size: int, device='cuda'):
+        self.n_way = n_way
+        self.n_shot = n_shot
+        self.n_data = n_way * n_shot
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self._buffers = {}
+
+        self.y_support = torch.arange(n_way, device=self.device).repeat_interleave(n_shot)
+        self.y_query = torch.arange(n_way, device=self.device).repeat_interleave(n_query_shot)
+        self.y_support_np = self.y_support.cpu().numpy()
+        self.y_query_np = self.y_query.cpu().numpy()
+
+        self.plan_buffers = PlanBuffers(self.n_data)
+        self.indices = torch.empty(self.n_data, dtype=torch.long, device=self.device)
+        self.indices_shuffled = torch.empty(self.n_data, dtype=torch.long, device=self.device)
+        self.y_shuffled = torch.empty_like(self.y_support)
+        self.y_batch = torch.empty(min(batch_size, self.n_data), dtype=torch.long, device=self.device)
+        self.y_shuffled_batch = torch.empty_like(self.y_batch)
+
+    def _get_buffer(self, name: str, shape, dtype: torch.dtype) -> torch.Tensor:
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = torch.empty(shape, dtype=dtype, device=self.device)
+        return buffer
+
+    def _load(self, name: str, x: torch.Tensor) -> torch.Tensor:
+        # Host-to-device copy into a staging buffer of the batch dtype (e.g., uint8), then normalized into the buffer
+        staging = self._get_buffer(name + '_staging', x.shape, x.dtype)
+        staging.copy_(x, non_blocking=True)
+        out = self._get_buffer(name, (*x.shape[:-3], 3, *x.shape[-2:]),
+                               torch.float32 if x.dtype == torch.uint8 else x.dtype)
+        return normalize_uint8(staging, out=out)
+
+    def load_support(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        :param x: Support batch of the data loader (on any device)
+        :return: Normalized support images, as `normalize_uint8(x.cuda())`
+        """
+        return self._load('support', x)
+
+    def load_query(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        :param x: Query batch of the data loader (on any device)
+        :return: Normalized query images, as `normalize_uint8(x.cuda())`
+        """
+        return self._load('query', x)
+
+    def draw_plan(self, params, epoch: int, image_shape, class_shuffled=None) -> EpochPlan:
+        """
+        Draws the plan of an epoch (see `finetuning.mix.draw_epoch_plan`) into the index buffers.
+        """
+        plan = draw_epoch_plan(params, epoch, self.n_way, self.n_shot, image_shape, class_shuffled,
+                               buffers=self.plan_buffers)
+        self.indices.copy_(self.plan_buffers.indices_tensor)
+        return plan
+
+    def apply_mix(self, plan: EpochPlan, x_support: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        In-place counterpart of `finetuning.mix.apply_mix` (for a plan of `draw_plan`).
+
+        :return: x_support_aug (x_support itself without MixUp/CutMix), y_shuffled (None without MixUp/CutMix)
+        """
+        if plan.lam is None:
+            return x_support, None
+        self.indices_shuffled.copy_(plan.indices_shuffled)
+        torch.index_select(self.y_support, 0, self.indices_shuffled, out=self.y_shuffled)
+        x_support_aug = self._get_buffer('support_aug', x_support.shape, x_support.dtype)
+        scratch = self._get_buffer('support_scratch', x_support.shape, x_support.dtype)
+        if plan.bbox is None:  # mixup: lam * x_support + (1 - lam) * x_support[indices_shuffled]
+            torch.index_select(x_support, 0, self.indices_shuffled, out=x_support_aug).mul_(1. - plan.lam)
+            x_support_aug.add_(torch.mul(x_support, plan.lam, out=scratch))
+        else:  # cutmix
+            bbx1, bby1, bbx2, bby2 = plan.bbox
+            x_support_aug.copy_(x_support)
+            box = x_support[:, :, bbx1:bbx2, bby1:bby2]
+            patch = scratch.view(-1)[:box.numel()].view(box.shape)
+            torch.index_select(box, 0, self.indices_shuffled, out=patch)
+            x_support_aug[:, :, bbx1:bbx2, bby1:bby2] = patch
+        return x_support_aug, self.y_shuffled
+
+    def get_batch(self, x: torch.Tensor, i: int, y_shuffled: torch.Tensor = None) \
+            -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Mini-batch i of the current permutation (see `draw_plan`), as `x[batch_indices]`, etc.
+
+        :return: x_batch, y_batch, y_shuffled_batch (None if y_shuffled is None)
+        """
+        batch_indices = self.indices[i * self.batch_size:min(i * self.batch_size + self.batch_size, self.n_data)]
+        n_batch = len(batch_indices)
+        x_batch = self._get_buffer('batch', (len(self.y_batch), *x.shape[1:]), x.dtype)[:n_batch]
+        torch.index_select(x, 0, batch_indices, out=x_batch)
+        y_batch = torch.index_select(self.y_support, 0, batch_indices, out=self.y_batch[:n_batch])
+        y_shuffled_batch = None
+        if y_shuffled is not None:
+            y_shuffled_batch = torch.index_select(y_shuffled, 0, batch_indices, out=self.y_shuffled_batch[:n_batch])
+        return x_batch, y_batch, y_shuffled_batch
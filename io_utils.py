@@ -78,10 +78,25 @@ def parse_args(mode):
     parser.add_argument('--ft_features', default=None, type=str, help='Specify which features to use from the base model (see model/base.py)')
     parser.add_argument('--ft_save_valid', action='store_true')
     parser.add_argument('--ft_intermediate_test', action='store_true', help='Evaluate on query set during fine-tuning')
+    parser.add_argument('--ft_cache_features', action='store_true', help='With --ft_parts head, no augmentation and no --v_score, compute support/query features once per episode and train the head on them (see finetuning/probe.py)')
+    parser.add_argument('--ft_probe_solver', default=None, type=str, choices=['sgd', 'lbfgs', 'ridge'], help='Train the linear heads of all episodes at once on cached features (implies --ft_cache_features, see finetuning/probe.py)')
+    parser.add_argument('--ft_fast_reset', default=None, type=str, choices=['host', 'device'], help='Reset the body, head and optimizer in place for each episode, from a snapshot of the pretrained body in pinned host memory or on the device (see finetuning/reset.py)')
+    parser.add_argument('--ft_ensemble', default=0, type=int, help='Fine-tune groups of this many episodes at once, with stacked models (0: one episode at a time, see finetuning/ensemble.py)')
     parser.add_argument('--ft_episode_seed', default=0, type=int)
+    parser.add_argument('--ft_prefetch_depth', default=0, type=int, help='Number of upcoming support/query/TTA batches to prepare in the background while fine-tuning (0: disabled), i.e., at most this many prefetched batches are held in memory')
+    parser.add_argument('--ft_data_store', default=None, type=str, help='Read target images from a data store directory, e.g., pre-decoded or sharded (see datasets/store.py)')
+    parser.add_argument('--ft_reduced_decode', action='store_true', help='Decode target images at reduced resolution, at or above the image size (see datasets/decode.py)')
+    parser.add_argument('--ft_uint8_transport', action='store_true', help='Send uint8 images from DataLoader workers and convert/normalize them on the GPU (identical results, 4x less IPC)')
+    parser.add_argument('--ft_unified_loader', action='store_true', help='Load support, query and TTA views of each episode from a single loader and worker pool (finetune_da_tta.py only, see datasets/episode.py)')
+    parser.add_argument('--ft_tta_multiview', action='store_true', help='Produce all TTA views of a query image from a single decode, as one [K, C, H, W] tensor per fetch (seeded via --ft_episode_seed)')
+    parser.add_argument('--ft_image_backend', default='pil', type=str, choices=['pil', 'torchvision'], help='Decode target images with PIL, or with torchvision.io to uint8 tensors (tensor transforms, not bit-identical to PIL)')
+    parser.add_argument('--ft_fetch_threads', default=0, type=int, help='Number of threads that decode the images of each episode batch within a loader worker (0: serial, see datasets/fetch.py)')
+    parser.add_argument('--ft_threaded_loader', action='store_true', help='Load episodes in the main process with a thread pool (--ft_fetch_threads, default 4) instead of worker processes. Augmentations then draw from the RNGs of the main process, i.e., results differ from worker-based loading (not supported with --ft_prefetch_depth)')
+    parser.add_argument('--ft_single_channel', action='store_true', help='Load grayscale target datasets (ChestX) with a single channel, expanded to 3 channels on the GPU (identical model inputs)')
 
     # augmentation options
     parser.add_argument('--ft_augmentation', default=None, type=str, help="Augmentation used for fine-tuning {None, 'base', 'strong'}")
+    parser.add_argument('--ft_batch_augmentation', action='store_true', help='Apply --ft_augmentation to the support set as batched tensor ops (see datasets/batch_transforms.py)')
     parser.add_argument('--ft_tta_augmentation', default=None, type=str, help="Augmentation used for fine-tuning {None, 'base', 'strong'}")
     parser.add_argument('--ft_cutmix', default=None, type=str ,help="CutMix Augmentation for fine-tuning {within, between, both}")
     parser.add_argument('--ft_mixup', default=None, type=str ,help="MixUp Augmentation for fine-tuning {within, between, both}")